@@ -0,0 +1,140 @@
+"""
+In-process stand-in for a Redis server, with the part of the redis-py client
+interface that cache.RedisCache uses.
+
+Keys and values are stored as bytes, like Redis returns them, and ``px`` expiry is
+honoured. Every command (and every pipeline as a whole) runs under one lock, so it
+can be shared by threads the way replicas share a server. ``eval`` only knows the
+scripts registered in SCRIPTS.
+"""
+import threading
+import time
+
+import cache
+
+def encode(value):
+    # redis-py sends str, int and float arguments as their UTF-8 text
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+def compare_and_delete(client, keys, args):
+    # cache.RedisCache._RELEASE: delete the lock only if it still holds this token
+    if client.get(keys[0]) == encode(args[0]):
+        return client.delete(keys[0])
+    return 0
+
+SCRIPTS = {cache.RedisCache._RELEASE: compare_and_delete}
+
+class Pipeline:
+    """
+    Commands queued on a FakeRedis and run together by ``execute``.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self._client, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self._client._lock:
+            results = [command(*args, **kwargs) for command, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+class FakeRedis:
+    """
+    Strings, sorted sets and hashes kept in dicts of this process.
+    """
+
+    def __init__(self):
+        self._strings = {}  # key -> (value, expires or None)
+        self._sorted_sets = {}  # key -> {member: score}
+        self._hashes = {}  # key -> {field: value}
+        self._lock = threading.RLock()
+
+    def _string(self, name):
+        entry = self._strings.get(name)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self._strings[name]
+            return None
+        return entry
+
+    def get(self, name):
+        with self._lock:
+            entry = self._string(encode(name))
+            return None if entry is None else entry[0]
+
+    def set(self, name, value, px=None, nx=False):
+        name = encode(name)
+        with self._lock:
+            if nx and self._string(name) is not None:
+                return None
+            self._strings[name] = (encode(value), None if px is None else time.time() + px / 1000)
+            return True
+
+    def exists(self, *names):
+        with self._lock:
+            return sum(self._string(encode(name)) is not None or encode(name) in self._sorted_sets or encode(name) in self._hashes
+                       for name in names)
+
+    def delete(self, *names):
+        with self._lock:
+            deleted = 0
+            for name in map(encode, names):
+                found = self._string(name) is not None or name in self._sorted_sets or name in self._hashes
+                self._strings.pop(name, None)
+                self._sorted_sets.pop(name, None)
+                self._hashes.pop(name, None)
+                deleted += found
+            return deleted
+
+    def zadd(self, name, mapping):
+        with self._lock:
+            members = self._sorted_sets.setdefault(encode(name), {})
+            added = sum(encode(member) not in members for member in mapping)
+            members.update({encode(member): float(score) for member, score in mapping.items()})
+            return added
+
+    def zrem(self, name, *values):
+        with self._lock:
+            members = self._sorted_sets.get(encode(name), {})
+            return sum(members.pop(encode(value), None) is not None for value in values)
+
+    def zrange(self, name, start, end):
+        with self._lock:
+            members = sorted(self._sorted_sets.get(encode(name), {}).items(), key=lambda item: (item[1], item[0]))
+        end = len(members) if end == -1 else end + 1
+        return [member for member, _ in members[start:end]]
+
+    def hset(self, name, key, value):
+        with self._lock:
+            fields = self._hashes.setdefault(encode(name), {})
+            added = encode(key) not in fields
+            fields[encode(key)] = encode(value)
+            return int(added)
+
+    def hdel(self, name, *keys):
+        with self._lock:
+            fields = self._hashes.get(encode(name), {})
+            return sum(fields.pop(encode(key), None) is not None for key in keys)
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._hashes.get(encode(name), {}))
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def eval(self, script, numkeys, *keys_and_args):
+        if script not in SCRIPTS:
+            raise NotImplementedError(f"Unknown script: {script}")
+        with self._lock:
+            return SCRIPTS[script](self, keys_and_args[:numkeys], keys_and_args[numkeys:])
@@ -0,0 +1,154 @@
+"""
+Local stand-in for the Socrata CSV API of analisi.transparenciacatalunya.cat.
+
+Serves DataFrames at ``/resource/<dataset id>.csv`` and understands the subset of
+SoQL that the app sends: ``$select`` (columns, ``:id``/``:updated_at``, ``*`` and
+``count(*)``), ``$where`` (comparisons with quoted literals joined by AND),
+``$order``, ``$limit`` and ``$offset``.
+"""
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+CONDITION = re.compile(r"\s*(:?\w+)\s*(>=|<=|!=|=|>|<)\s*'([^']*)'\s*")
+COMPARISONS = {
+    '=': lambda column, value: column == value,
+    '!=': lambda column, value: column != value,
+    '>': lambda column, value: column > value,
+    '>=': lambda column, value: column >= value,
+    '<': lambda column, value: column < value,
+    '<=': lambda column, value: column <= value,
+}
+
+def apply_where(df, where):
+    # Conditions joined by AND; parentheses only group, so they can be dropped
+    for condition in re.split(r'\s+AND\s+', where.replace('(', ' ').replace(')', ' '), flags=re.IGNORECASE):
+        match = CONDITION.fullmatch(condition)
+        if match is None:
+            raise ValueError(f"Unsupported $where condition: {condition}")
+        name, operator, value = match.groups()
+        column = df[name]
+        if pd.api.types.is_datetime64_any_dtype(column):
+            value = pd.Timestamp(value, tz='UTC')
+        else:
+            column = column.astype(str)
+        df = df[COMPARISONS[operator](column, value)]
+    return df
+
+def select_columns(df, select):
+    columns = []
+    for name in (name.strip() for name in select.split(',')):
+        columns += [column for column in df.columns if not column.startswith(':')] if name == '*' else [name]
+    return df[columns]
+
+def to_socrata_csv(page):
+    # Socrata writes timestamps as ISO 8601 with milliseconds
+    for column in page.columns:
+        if pd.api.types.is_datetime64_any_dtype(page[column]):
+            page = page.assign(**{column: page[column].dt.strftime('%Y-%m-%dT%H:%M:%S.%f').str[:-3] + 'Z'})
+    return page.to_csv(index=False)
+
+class FakeSocrata:
+    """
+    Threaded HTTP server answering SoQL requests from in-memory DataFrames.
+
+    Args:
+    - datasets: Dict mapping the dataset id (e.g. '99md-r3rq') to its DataFrame.
+    - latency: Seconds added to every response, to mimic the network round trip.
+    - fail_every: When set, every n-th request is answered with HTTP 503.
+    - truncate_every: When set, every n-th response announces its full length but the
+      connection is closed halfway through the body.
+
+    Use as a context manager, or call start() and stop(). ``url(dataset_id)`` gives
+    the resource URL to pass to fetch_data.
+    """
+
+    def __init__(self, datasets, latency=0.0, fail_every=None, truncate_every=None):
+        self.datasets = datasets
+        self.latency = latency
+        self.fail_every = fail_every
+        self.truncate_every = truncate_every
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def url(self, dataset_id):
+        return f"http://127.0.0.1:{self._server.server_port}/resource/{dataset_id}.csv"
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def respond(self, path, query):
+        # Status code and body for one request
+        dataset_id = path.rsplit('/', 1)[-1].split('.')[0]
+        if dataset_id not in self.datasets:
+            return 404, ''
+        df = self.datasets[dataset_id]
+        params = {name: values[0] for name, values in parse_qs(query).items()}
+
+        if '$where' in params:
+            df = apply_where(df, params['$where'])
+        select = params.get('$select', '*')
+        if select.replace(' ', '') == 'count(*)':
+            return 200, f'"count"\n"{len(df)}"\n'
+
+        if '$order' in params:
+            keys = [key.split()[0] for key in params['$order'].split(',')]
+            ascending = [not key.strip().upper().endswith(' DESC') for key in params['$order'].split(',')]
+            df = df.sort_values(keys, ascending=ascending, kind='stable')
+        offset = int(params.get('$offset', 0))
+        limit = int(params.get('$limit', 1000))
+        page = select_columns(df, select).iloc[offset:offset + limit]
+        return 200, to_socrata_csv(page) if len(page) else ''
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.requests += 1
+                    failing = fake.fail_every and fake.requests % fake.fail_every == 0
+                    truncating = fake.truncate_every and fake.requests % fake.truncate_every == 0
+                if fake.latency:
+                    threading.Event().wait(fake.latency)
+
+                parsed = urlparse(self.path)
+                status, body = (503, '') if failing else fake.respond(parsed.path, parsed.query)
+                payload = body.encode()
+                with fake._lock:
+                    fake.bytes_sent += len(payload)
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/csv; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                if truncating:
+                    self.wfile.write(payload[:len(payload) // 2])
+                    self.close_connection = True
+                else:
+                    self.wfile.write(payload)
+
+        return Handler
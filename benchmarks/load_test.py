@@ -0,0 +1,340 @@
+"""
+Load test: many concurrent sessions driving the whole app headless against a local
+fake Socrata endpoint, to plan how many families one app process can serve.
+
+Usage:
+    python -m benchmarks.load_test --sessions 1 10 25 --output load.json
+
+Every session is a Streamlit AppTest running in its own thread of this process, as
+sessions do in a Streamlit server, and repeats a family's flow ``--iterations`` times:
+
+1. open "Busca una escola", search a school by patron and municipality, typed without
+   accents, and open it;
+2. switch the curs of the inscriptions chart;
+3. open "Compara escoles", search and add schools until 5 are compared, and switch
+   the curs of the comparison.
+
+For each number of sessions the p50/p95/p99 rerun latency (overall and per step),
+the CPU time and the growth of resident memory per session are reported, followed by
+the errors grouped by step, exception type and message. Rerun times include
+AppTest's own overhead of running the script and parsing its output.
+"""
+import argparse
+import contextlib
+import ctypes
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import warnings
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, app_test, local_script_runner
+from streamlit.testing.v1.util import patch_config_options
+
+from benchmarks import synthetic_data
+from benchmarks.fake_socrata import FakeSocrata
+from benchmarks.run_benchmarks import git_commit
+
+SEARCH_TAB = "Busca una escola"
+COMPARE_TAB = "Compara escoles"
+COMPARED_SCHOOLS = 5
+PERCENTILES = (50, 95, 99)
+
+def release_memory():
+    # Collect garbage and return the freed heap to the system, so that RSS is what is in use (glibc)
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def rss_bytes():
+    # Current resident set size of this process (Linux), or the peak where /proc is missing
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return peak_rss_bytes()
+
+def peak_rss_bytes():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def widget(widgets, label):
+    # The widget of a list with the given label (the curs selectors have no key)
+    for w in widgets:
+        if w.label == label:
+            return w
+    raise LookupError(f"No widget labelled {label!r}")
+
+@contextlib.contextmanager
+def concurrent_app_tests():
+    """
+    Let AppTests run in concurrent threads, which they are not written for.
+
+    Each AppTest run patches the global ``global.appTest`` option and sets the global
+    Runtime singleton, and undoes both when it ends, in the middle of the other runs:
+    the option stays patched here and the singleton falls back to the last runtime set
+    (they are all alike). Each run also compiles the script, which is not thread-safe
+    in CPython; the server compiles it once into the ScriptCache of its runtime, shared
+    here the same way.
+    """
+    script_cache = ScriptCache()
+    last_runtime = None
+
+    def runtime_instance(cls):
+        nonlocal last_runtime
+        if cls._instance is not None:
+            last_runtime = cls._instance
+        if last_runtime is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        return last_runtime
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(patch_config_options({'global.appTest': True}))
+        stack.enter_context(mock.patch.object(Runtime, 'instance', classmethod(runtime_instance)))
+        stack.enter_context(mock.patch.object(Runtime, 'exists', classmethod(lambda cls: True)))
+        for module in (app_test, local_script_runner):
+            stack.enter_context(mock.patch.object(module, 'ScriptCache', lambda: script_cache))
+        yield
+
+class Session:
+    """
+    One simulated family: an AppTest and the timings of the reruns it triggered.
+    """
+
+    def __init__(self, app_path, queries, rng, think_time, timeout):
+        self.app = AppTest.from_file(app_path, default_timeout=timeout)
+        self.queries = queries
+        # AppTest lists the options of the school selectors by their label
+        self.codes = {label: code for code, label, _ in queries}
+        self.rng = rng
+        self.think_time = think_time
+        self.timings = []  # (step, seconds)
+        self.failures = []  # (step, exception type, message)
+        self.tab = SEARCH_TAB
+
+    def step(self, name, action=None):
+        # Apply a widget change and time the rerun it triggers; AppTest does not keep the open tab
+        if self.think_time:
+            time.sleep(self.rng.exponential(self.think_time))
+        self.app.session_state['active_tab'] = self.tab
+        if action is not None:
+            action()
+        start = time.perf_counter()
+        try:
+            self.app.run()
+        finally:
+            self.timings.append((name, time.perf_counter() - start))
+        for exception in self.app.exception:
+            self.fail(name, exception.proto.type, exception.message)
+
+    def fail(self, step, type_, message):
+        # First line of the message, so that the same error groups alike in the report
+        self.failures.append((step, type_, message.strip().split('\n', 1)[0][:200]))
+
+    def query(self):
+        return self.queries[self.rng.integers(len(self.queries))]
+
+    def search_school(self):
+        if self.tab != SEARCH_TAB:
+            self.tab = SEARCH_TAB
+            self.step('open_search')
+        code, label, query = self.query()
+        self.step('search', lambda: self.app.text_input(key='school_query').input(query))
+        selectbox = self.app.selectbox(key='school_code')
+        if label in selectbox.options and selectbox.value != code:
+            self.step('select_school', lambda: selectbox.select(code))
+
+    def switch_curs(self):
+        curs = widget(self.app.selectbox, 'Selecciona un curs escolar:')
+        self.step('switch_curs', lambda: curs.select_index(self.rng.integers(len(curs.options))))
+
+    def compare_schools(self):
+        self.tab = COMPARE_TAB
+        self.step('open_comparison')
+        for _ in range(COMPARED_SCHOOLS * 2):
+            selected = self.app.multiselect(key='compare_codes').value
+            if len(selected) >= COMPARED_SCHOOLS:
+                break
+            code, label, query = self.query()
+            self.step('search_comparison', lambda: self.app.text_input(key='compare_query').input(query))
+            multiselect = self.app.multiselect(key='compare_codes')
+            candidates = [self.codes[option] for option in multiselect.options if self.codes[option] not in multiselect.value]
+            if candidates:
+                self.step('add_school', lambda: multiselect.select(code if code in candidates else candidates[0]))
+        curs = self.app.selectbox(key='unique_curs_key')
+        self.step('switch_comparison_curs', lambda: curs.select_index(self.rng.integers(len(curs.options))))
+
+    def run(self, iterations):
+        self.step('open')
+        for _ in range(iterations):
+            # A failed rerun (or a widget missing after it) counts as an error and the flow starts over
+            for flow in (self.search_school, self.switch_curs, self.compare_schools):
+                try:
+                    flow()
+                except Exception as e:
+                    self.fail(flow.__name__, type(e).__name__, str(e))
+                    break
+
+def school_queries(dataset):
+    """
+    (codi_centre, label, query) of every school of the app's PreparedDataset: the label
+    its selectors show and a query typed the way families do, lowercase and without
+    accents, with the school's patron followed by its municipality.
+    """
+    import escoles2
+
+    schools = dataset.df.drop_duplicates('codi_centre')
+    queries = []
+    for code, name, municipality in zip(schools['codi_centre'].astype(str), schools['denominaci_completa'].astype(str), schools['nom_municipi'].astype(str)):
+        patron = next(patron for patron in synthetic_data.PATRONS if patron in name)
+        queries.append((code, dataset.school_label(code), escoles2.normalize_text(f"{patron} {municipality}")))
+    return queries
+
+def summarize(values):
+    values = np.asarray(values) * 1000
+    return {f'p{q}': float(np.percentile(values, q)) for q in PERCENTILES} | {'max': float(values.max()), 'n': len(values)}
+
+def run_level(app_path, n_sessions, queries, args):
+    """
+    Run ``n_sessions`` sessions concurrently and summarize their reruns.
+
+    The sessions are kept alive until the end, so the memory growth is what that
+    many open sessions hold together.
+    """
+    rng = np.random.default_rng(args.seed + n_sessions)
+    sessions = [Session(app_path, queries, np.random.default_rng(rng.integers(2 ** 32)), args.think_time, args.timeout)
+                for _ in range(n_sessions)]
+
+    release_memory()
+    rss_before, cpu_before = rss_bytes(), cpu_seconds()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_sessions) as executor:
+        for future in [executor.submit(session.run, args.iterations) for session in sessions]:
+            future.result()
+    wall = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu_before
+    release_memory()
+    rss_after = rss_bytes()
+
+    timings = [timing for session in sessions for timing in session.timings]
+    failures = Counter(failure for session in sessions for failure in session.failures)
+    steps = {}
+    for name, seconds in timings:
+        steps.setdefault(name, []).append(seconds)
+    return {
+        'sessions': n_sessions,
+        'reruns': len(timings),
+        'errors': sum(failures.values()),
+        'failures': [{'step': step, 'type': type_, 'message': message, 'count': n} for (step, type_, message), n in failures.most_common()],
+        'wall_s': wall,
+        'reruns_per_s': len(timings) / wall,
+        'latency_ms': summarize([seconds for _, seconds in timings]),
+        'steps_ms': {name: summarize(values) for name, values in steps.items()},
+        'cpu_s': cpu,
+        'cpu_s_per_session': cpu / n_sessions,
+        'cpu_ms_per_rerun': cpu / len(timings) * 1000,
+        'rss_bytes_per_session': (rss_after - rss_before) / n_sessions,
+        'rss_bytes': rss_after,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+def report(level):
+    latency = level['latency_ms']
+    print(f"{level['sessions']:>8} {latency['p50']:>9.1f} {latency['p95']:>9.1f} {latency['p99']:>9.1f}"
+          f" {level['reruns_per_s']:>9.1f} {level['cpu_ms_per_rerun']:>11.1f} {level['cpu_s_per_session']:>12.2f}"
+          f" {level['rss_bytes_per_session'] / 2 ** 20:>12.1f} {level['rss_bytes'] / 2 ** 20:>8.0f} {level['errors']:>6}", file=sys.stderr)
+    for failure in level['failures']:
+        print(f"{failure['count']:>8} × {failure['step']}: {failure['type']}: {failure['message']}", file=sys.stderr)
+
+def run(args):
+    datasets = synthetic_data.make_datasets(args.schools, args.years, args.ensenyaments, args.levels, args.seed)
+    levels = []
+
+    with FakeSocrata(datasets, latency=args.latency) as server, tempfile.TemporaryDirectory() as directory:
+        os.environ.update({
+            'ESCOLES_PREINSCRIPCIO_URL': server.url(synthetic_data.PREINSCRIPCIO_ID),
+            'ESCOLES_ESCOLES_URL': server.url(synthetic_data.ESCOLES_ID),
+            'ESCOLES_SNAPSHOT_DIR': os.path.join(directory, 'snapshots'),
+            'ESCOLES_ARTIFACT_DIR': os.path.join(directory, 'artifacts'),
+            'ESCOLES_STATIC_DIR': os.path.join(directory, 'static'),
+        })
+        # Its settings are read at import, so only once the environment points at the fake endpoint
+        import escoles2
+        # Streamlit also warns about deprecations on every rerun
+        escoles2.quiet_streamlit_logs()
+
+        # One session opens the app first, so that the dataset is loaded
+        start = time.perf_counter()
+        Session(escoles2.__file__, [], np.random.default_rng(args.seed), 0, args.timeout).step('open')
+        # The dataset of the snapshots the app wrote, to search its schools by their codes and labels
+        queries = school_queries(escoles2.load_snapshot_dataset(server.url(synthetic_data.PREINSCRIPCIO_ID), server.url(synthetic_data.ESCOLES_ID)))
+        print(f"dataset loaded in {time.perf_counter() - start:.1f} s, {rss_bytes() / 2 ** 20:.0f} MiB resident", file=sys.stderr)
+
+        print(f"{'sessions':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'reruns/s':>9} {'cpu ms/run':>11}"
+              f" {'cpu s/sess':>12} {'MiB/session':>12} {'RSS MiB':>8} {'errors':>6}", file=sys.stderr)
+        with concurrent_app_tests():
+            # and goes through the flow once, so that the steady state is measured
+            Session(escoles2.__file__, queries, np.random.default_rng(args.seed), 0, args.timeout).run(1)
+            for n_sessions in args.sessions:
+                level = run_level(escoles2.__file__, n_sessions, queries, args)
+                report(level)
+                levels.append(level)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'cpus': os.cpu_count(),
+            'params': vars(args) | {'output': None},
+            'rows': {dataset_id: len(df) for dataset_id, df in datasets.items()},
+        },
+        'levels': levels,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 5, 10], help="numbers of concurrent sessions to run, one after another")
+    parser.add_argument('--iterations', type=int, default=2, help="times each session repeats the flow")
+    parser.add_argument('--think-time', type=float, default=0.0, help="mean seconds a family waits between interactions")
+    parser.add_argument('--timeout', type=float, default=600, help="seconds a rerun may take before it counts as failed")
+    parser.add_argument('--schools', type=int, default=2000, help="number of synthetic schools")
+    parser.add_argument('--years', type=int, default=5, help="number of preinscription courses")
+    parser.add_argument('--ensenyaments', type=int, default=4, help="number of distinct ensenyaments")
+    parser.add_argument('--levels', type=int, default=6, help="maximum nivells per ensenyament")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every fake Socrata response")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+if __name__ == '__main__':
+    main()
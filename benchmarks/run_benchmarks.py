@@ -0,0 +1,255 @@
+"""
+Time each stage of the app on synthetic data served by a local fake Socrata endpoint.
+
+Usage:
+    python -m benchmarks.run_benchmarks --schools 2000 --output bench.json
+    python -m benchmarks.run_benchmarks --compare bench.json
+
+Every stage is run ``--repeat`` times for the wall time and once more under
+tracemalloc for the peak of Python-tracked memory. Finally the whole app is rerun
+``--reruns`` times through Streamlit's AppTest to measure what one rerun allocates. The results are written as JSON
+so runs from different commits can be compared with ``--compare``.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from datetime import datetime, timezone
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthetic_data
+from benchmarks.fake_socrata import FakeSocrata
+
+def uncached(func):
+    # The function wrapped by st.cache_data/st.cache_resource, so every run does the work
+    return getattr(func, '__wrapped__', func)
+
+def measure(stage, repeat):
+    """
+    Run ``stage`` ``repeat`` times for the wall time and once under tracemalloc.
+
+    ``stage`` returns the number of operations it performed, so that per-operation
+    times can be reported for stages that loop over many schools.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operations = stage()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    stage()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'operations': operations,
+        'wall_s': {'median': statistics.median(times), 'min': min(times), 'max': max(times), 'runs': times},
+        'wall_s_per_operation': statistics.median(times) / operations,
+        'peak_bytes': peak,
+    }
+
+def measure_reruns(server, repeat):
+    """
+    Drive the whole app headless with Streamlit's AppTest against the fake endpoint and
+    measure the reruns triggered by selecting a different school.
+
+    The first run (which loads and prepares the dataset) is not measured. Each later
+    rerun reports its wall time and the peak of memory allocated while it ran, which
+    should not grow with the size of the dataset.
+    """
+    from streamlit.testing.v1 import AppTest
+    import escoles2
+
+    with tempfile.TemporaryDirectory() as directory, mock.patch.dict(os.environ, {
+        'ESCOLES_PREINSCRIPCIO_URL': server.url(synthetic_data.PREINSCRIPCIO_ID),
+        'ESCOLES_ESCOLES_URL': server.url(synthetic_data.ESCOLES_ID),
+        'ESCOLES_SNAPSHOT_DIR': os.path.join(directory, 'snapshots'),
+        'ESCOLES_ARTIFACT_DIR': os.path.join(directory, 'artifacts'),
+        'ESCOLES_STATIC_DIR': os.path.join(directory, 'static'),
+    }):
+        app = AppTest.from_file(escoles2.__file__, default_timeout=600)
+        app.run()
+
+        times, peaks = [], []
+        for i in range(1, repeat + 1):
+            app.selectbox[0].select_index(i % len(app.selectbox[0].options))
+            tracemalloc.start()
+            start = time.perf_counter()
+            app.run()
+            times.append(time.perf_counter() - start)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        if app.exception:
+            raise RuntimeError(app.exception[0].value)
+
+    return {
+        'operations': 1,
+        'wall_s': {'median': statistics.median(times), 'min': min(times), 'max': max(times), 'runs': times},
+        'wall_s_per_operation': statistics.median(times),
+        'peak_bytes': int(statistics.median(peaks)),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    import escoles2
+
+    escoles2.quiet_streamlit_logs()
+    datasets = synthetic_data.make_datasets(args.schools, args.years, args.ensenyaments, args.levels, args.seed)
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    loaded = {}
+
+    def record(name, stage):
+        results[name] = measure(stage, args.repeat)
+        result = results[name]
+        print(f"{name:<32} {result['wall_s']['median'] * 1000:>10.2f} ms"
+              f" ({result['wall_s_per_operation'] * 1000:.2f} ms x {result['operations']})"
+              f" {result['peak_bytes'] / 2 ** 20:>9.1f} MiB", file=sys.stderr)
+
+    with FakeSocrata(datasets, latency=args.latency) as server:
+        for dataset_id, query in [(synthetic_data.PREINSCRIPCIO_ID, escoles2.PREINSCRIPCIO_QUERY),
+                                  (synthetic_data.ESCOLES_ID, escoles2.ESCOLES_QUERY)]:
+            def fetch(dataset_id=dataset_id, query=query):
+                loaded[dataset_id] = uncached(escoles2.fetch_data)(server.url(dataset_id), query, limit=args.page_size)
+                return 1
+            record(f"fetch_data[{dataset_id}]", fetch)
+
+    def preprocess():
+        loaded['df'] = escoles2.preprocess_school_data(loaded[synthetic_data.PREINSCRIPCIO_ID].copy(), loaded[synthetic_data.ESCOLES_ID].copy())
+        return 1
+    record('preprocess_school_data', preprocess)
+
+    # Bytes the SCHOOL_SCHEMA dtypes save on the merged frame
+    report = escoles2.memory_report(
+        escoles2.preprocess_school_data(loaded[synthetic_data.PREINSCRIPCIO_ID], loaded[synthetic_data.ESCOLES_ID], schema=None), loaded['df'])
+    schema_memory = {name: int(report.loc['total', name]) for name in ('bytes_before', 'bytes_after')}
+    print(f"{'school_schema':<32} {schema_memory['bytes_before'] / 2 ** 20:>10.1f} MiB -> {schema_memory['bytes_after'] / 2 ** 20:.1f} MiB"
+          f" ({report.loc['total', 'ratio']:.0%})", file=sys.stderr)
+
+    def prepare():
+        loaded['dataset'] = escoles2.PreparedDataset(loaded['df'])
+        return 1
+    record('prepare_dataset', prepare)
+
+    dataset = loaded['dataset']
+    sample = [dataset.school_options[i] for i in rng.choice(len(dataset.school_options), min(args.sample, len(dataset.school_options)), replace=False)]
+    school_dfs = {school: dataset.school(school) for school in sample}
+    school_infos = {school: school_df.iloc[0] for school, school_df in school_dfs.items()}
+
+    def per_school(func):
+        def stage():
+            for school in sample:
+                func(school)
+            return len(sample)
+        return stage
+
+    record('search_schools', per_school(lambda school: dataset.search(str(school_infos[school]['denominaci_completa'])[:6])))
+    record('school_selection', per_school(dataset.school))
+    record('get_nearby_schools_df', per_school(lambda school: escoles2.get_nearby_schools_df(dataset, school_infos[school])))
+    record('get_closest_schools_df', per_school(lambda school: escoles2.get_closest_schools_df(dataset, school_infos[school])))
+
+    # The JSON a rerun sends for the map: the published base layer plus the selected school
+    with tempfile.TemporaryDirectory() as directory:
+        base_layer = escoles2.create_pydeck_layer(
+            escoles2.publish_school_points(dataset.school_points, directory), '[169, 169, 169, 160]', 'schools')
+    record('map_layers', per_school(lambda school: escoles2.pdk.Deck(layers=[base_layer, escoles2.create_pydeck_layer(
+        dataset.school_points[dataset.school_points['codi_centre'] == school_infos[school]['codi_centre']], '[255, 0, 0, 160]', 'selected')]).to_json()))
+
+    def evolution(school):
+        for ense in school_dfs[school]['nom_ensenyament'].unique():
+            uncached(escoles2.build_evolution_figure)(school_dfs[school], dataset.version, school, ense).to_json()
+    record('plot_pre_registration_evolution', per_school(evolution))
+
+    def inscriptions(school):
+        school_df = school_dfs[school]
+        curs = school_df['curs'].iloc[0]
+        for ense in school_df['nom_ensenyament'].unique():
+            uncached(escoles2.build_inscriptions_figure)(school_df, dataset.version, school, ense, curs).to_json()
+    record('plot_inscriptions_by_curs', per_school(inscriptions))
+
+    def ranking(school):
+        area_cube = dataset.area_cube('nom_municipi', school_infos[school]['nom_municipi'])
+        area_cube = area_cube[area_cube['entry_level'] & (area_cube['curs'] == school_infos[school]['curs'])]
+        return area_cube.sort_values('oversubscription', ascending=False).head(escoles2.RANKING_SIZE)
+    record('ranking', per_school(ranking))
+
+    comparison_df = dataset.schools(sample[:5])
+    comparison_df = comparison_df[(comparison_df['curs'] == comparison_df['curs'].iloc[0]) & (comparison_df['nivell'] == 1)]
+    record('plot_data_across_schools', lambda: escoles2.build_comparison_figure(comparison_df).to_json() and 1)
+
+    if args.reruns:
+        with FakeSocrata(datasets) as server:
+            results['rerun_select_school'] = measure_reruns(server, args.reruns)
+        print(f"{'rerun_select_school':<32} {results['rerun_select_school']['wall_s']['median'] * 1000:>10.2f} ms"
+              f" {results['rerun_select_school']['peak_bytes'] / 2 ** 20:>9.1f} MiB", file=sys.stderr)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'params': vars(args) | {'output': None, 'compare': None},
+            'rows': {dataset_id: len(df) for dataset_id, df in datasets.items()},
+        },
+        'stages': results,
+        'schema_memory': schema_memory,
+    }
+
+def compare(current, baseline):
+    # Print the median wall time and peak memory of each stage against a previous run
+    print(f"{'stage':<32} {'wall ms':>10} {'vs base':>8} {'peak MiB':>9} {'vs base':>8}")
+    for name, stage in current['stages'].items():
+        base = baseline['stages'].get(name)
+        wall, peak = stage['wall_s']['median'], stage['peak_bytes']
+        wall_ratio = f"{wall / base['wall_s']['median']:.2f}x" if base else '-'
+        peak_ratio = f"{peak / base['peak_bytes']:.2f}x" if base and base['peak_bytes'] else '-'
+        print(f"{name:<32} {wall * 1000:>10.2f} {wall_ratio:>8} {peak / 2 ** 20:>9.1f} {peak_ratio:>8}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--schools', type=int, default=2000, help="number of synthetic schools")
+    parser.add_argument('--years', type=int, default=5, help="number of preinscription courses")
+    parser.add_argument('--ensenyaments', type=int, default=4, help="number of distinct ensenyaments")
+    parser.add_argument('--levels', type=int, default=6, help="maximum nivells per ensenyament")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--page-size', type=int, default=1000, help="rows per Socrata page")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every fake Socrata response")
+    parser.add_argument('--sample', type=int, default=50, help="schools used by the per-school stages")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage")
+    parser.add_argument('--reruns', type=int, default=5, help="app reruns measured through AppTest (0 to skip)")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
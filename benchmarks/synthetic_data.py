@@ -0,0 +1,151 @@
+"""
+Synthetic versions of the two open datasets used by the app.
+
+The frames have the columns of the Socrata resources (plus a few the app does not
+use, so that column selection has something to cut) and the ``:id``/``:updated_at``
+system fields, so they can be served by ``fake_socrata``.
+"""
+import numpy as np
+import pandas as pd
+
+PREINSCRIPCIO_ID = '99md-r3rq'
+ESCOLES_ID = 'kvmv-ahh4'
+
+# (nom_ensenyament, number of nivells)
+ENSENYAMENTS = [
+    ("Educació infantil de primer cicle", 3),
+    ("Educació infantil de segon cicle", 3),
+    ("Educació primària", 6),
+    ("Educació secundària obligatòria", 4),
+    ("Batxillerat", 2),
+    ("Cicles formatius de grau mitjà", 2),
+]
+NATURALESES = ["Públic", "Privat"]
+MUNICIPIS = ["Barcelona", "L'Hospitalet de Llobregat", "Badalona", "Terrassa", "Sabadell", "Lleida",
+             "Tarragona", "Mataró", "Santa Coloma de Gramenet", "Reus", "Girona", "Sant Cugat del Vallès",
+             "Cornellà de Llobregat", "Sant Boi de Llobregat", "Manresa", "Rubí", "Vilanova i la Geltrú",
+             "Viladecans", "Castelldefels", "El Prat de Llobregat", "Granollers", "Cerdanyola del Vallès",
+             "Sant Adrià de Besòs", "Mollet del Vallès", "Figueres", "Vic", "Igualada", "Olot", "Tortosa", "Salt"]
+COMARQUES = ["Barcelonès", "Vallès Occidental", "Segrià", "Tarragonès", "Maresme", "Baix Camp", "Gironès",
+             "Baix Llobregat", "Bages", "Garraf", "Vallès Oriental", "Alt Empordà", "Osona", "Anoia",
+             "Garrotxa", "Baix Ebre"]
+PREFIXES = ["Escola", "Institut", "Col·legi", "Escola Bressol", "Institut Escola"]
+PATRONS = ["Sant Jordi", "Pau Casals", "Mercè Rodoreda", "Joan Miró", "Antoni Gaudí", "Àngel Guimerà",
+           "Jacint Verdaguer", "Montserrat", "Mare de Déu", "Pompeu Fabra", "Rosa Sensat", "Ramon Llull",
+           "Francesc Macià", "Salvador Espriu", "Maria Aurèlia Capmany", "Lluís Vives"]
+
+def make_schools(n_schools, rng):
+    # One row per school: code, name, municipality, comarca, naturalesa and a point near its municipality
+    municipi = rng.integers(0, len(MUNICIPIS), n_schools)
+    centre_lat = 40.6 + (np.arange(len(MUNICIPIS)) * 0.61 % 2.1)
+    centre_lon = 0.4 + (np.arange(len(MUNICIPIS)) * 0.37 % 2.8)
+    return pd.DataFrame({
+        'codi_centre': [f"{8000000 + i * 7:08d}" for i in range(n_schools)],
+        'denominaci_completa': [f"{PREFIXES[i % len(PREFIXES)]} {PATRONS[(i // len(PREFIXES)) % len(PATRONS)]} {i}" for i in range(n_schools)],
+        'nom_municipi': np.array(MUNICIPIS)[municipi],
+        'nom_comarca': np.array(COMARQUES)[municipi % len(COMARQUES)],
+        'nom_naturalesa': np.array(NATURALESES)[rng.integers(0, len(NATURALESES), n_schools)],
+        'coordenades_geo_y': centre_lat[municipi] + rng.normal(0, 0.02, n_schools),
+        'coordenades_geo_x': centre_lon[municipi] + rng.normal(0, 0.02, n_schools),
+    })
+
+def system_fields(n_rows, rng, prefix):
+    # Socrata row ids and last update times spread over the previous year
+    updated = pd.Timestamp('2024-01-01', tz='UTC') + pd.to_timedelta(rng.integers(0, 365 * 86400, n_rows), unit='s')
+    return {':id': [f"row-{prefix}-{i:08d}" for i in range(n_rows)], ':updated_at': updated}
+
+def make_preinscripcio(schools, n_years, n_ensenyaments, max_levels, rng, first_year=2024):
+    """
+    Rows of 99md-r3rq: one per school, curs, ensenyament and nivell.
+
+    Each school offers a random subset of the first ``n_ensenyaments`` ensenyaments.
+    """
+    ensenyaments = ENSENYAMENTS[:n_ensenyaments]
+    offered = rng.random((len(schools), len(ensenyaments))) < 0.6
+    offered[:, 0] = True
+
+    school_idx, ense_idx = np.nonzero(offered)
+    levels = np.array([min(levels, max_levels) for _, levels in ensenyaments])[ense_idx]
+    school_idx = np.repeat(school_idx, levels)
+    ense_idx = np.repeat(ense_idx, levels)
+    nivell = np.concatenate([np.arange(1, n + 1) for n in levels])
+
+    n_per_year = len(school_idx)
+    years = np.repeat(np.arange(first_year - n_years + 1, first_year + 1), n_per_year)
+    school_idx, ense_idx, nivell = np.tile(school_idx, n_years), np.tile(ense_idx, n_years), np.tile(nivell, n_years)
+    n_rows = len(years)
+
+    offer = rng.integers(1, 4, n_rows) * 25
+    first_choice = np.minimum(offer, rng.poisson(offer * 0.9))
+    other = np.minimum(offer - first_choice, rng.poisson(offer * 0.1))
+    rows = schools.iloc[school_idx].reset_index(drop=True)
+
+    return pd.DataFrame({
+        **system_fields(n_rows, rng, 'p'),
+        'curs': [f"{year}/{year + 1}" for year in years],
+        'codi_centre': rows['codi_centre'],
+        'denominaci_completa': rows['denominaci_completa'],
+        'nom_naturalesa': rows['nom_naturalesa'],
+        'codi_delegaci': 'CEB',
+        'nom_delegaci': "Consorci d'Educació de Barcelona",
+        'nom_comarca': rows['nom_comarca'],
+        'nom_municipi': rows['nom_municipi'],
+        'codi_ensenyament': [f"E{i:02d}" for i in ense_idx],
+        'nom_ensenyament': np.array([name for name, _ in ensenyaments])[ense_idx],
+        'nivell': nivell,
+        'oferta_inicial_places': offer,
+        'assignacions_1a_peticio': first_choice,
+        'assignacions_altres_peticions': other,
+        'coordenades_geo_x': rows['coordenades_geo_x'],
+        'coordenades_geo_y': rows['coordenades_geo_y'],
+    })
+
+def make_escoles(schools, n_years, rng, first_year=2023, missing_coordinates=0.02):
+    # Rows of kvmv-ahh4: the school directory, one row per school and year
+    n_rows = len(schools) * n_years
+    rows = pd.concat([schools] * n_years, ignore_index=True)
+    years = np.repeat(np.arange(first_year - n_years + 1, first_year + 1), len(schools))
+    lon = rows['coordenades_geo_x'].to_numpy().copy()
+    lat = rows['coordenades_geo_y'].to_numpy().copy()
+    missing = rng.random(n_rows) < missing_coordinates
+    lon[missing] = np.nan
+    lat[missing] = np.nan
+
+    return pd.DataFrame({
+        **system_fields(n_rows, rng, 'e'),
+        'any': years,
+        'codi_centre': rows['codi_centre'],
+        'denominaci_completa': rows['denominaci_completa'],
+        'nom_naturalesa': rows['nom_naturalesa'],
+        'nom_titularitat': 'Departament d\'Educació',
+        'adre_a': [f"C. {PATRONS[i % len(PATRONS)]}, {i % 200 + 1}" for i in range(n_rows)],
+        'codi_postal': [f"08{i % 1000:03d}" for i in range(n_rows)],
+        'tel_fon': [f"93{i % 10000000:07d}" for i in range(n_rows)],
+        'e_mail_centre': [f"a{code}@xtec.cat" for code in rows['codi_centre']],
+        'url': [f"https://agora.xtec.cat/{code}/" for code in rows['codi_centre']],
+        'nom_municipi': rows['nom_municipi'],
+        'nom_comarca': rows['nom_comarca'],
+        'estudis': 'EINF2C;EPRI;ESO',
+        'coordenades_geo_x': lon,
+        'coordenades_geo_y': lat,
+    })
+
+def make_datasets(n_schools=1000, n_years=5, n_ensenyaments=3, max_levels=6, seed=0):
+    """
+    Build both synthetic datasets.
+
+    Args:
+    - n_schools: Number of schools.
+    - n_years: Number of preinscription courses (and directory years).
+    - n_ensenyaments: Number of distinct ensenyaments (at most len(ENSENYAMENTS)).
+    - max_levels: Maximum number of nivells per ensenyament.
+    - seed: Seed of the random generator.
+
+    Returns a dict mapping the Socrata dataset id to its DataFrame.
+    """
+    rng = np.random.default_rng(seed)
+    schools = make_schools(n_schools, rng)
+    return {
+        PREINSCRIPCIO_ID: make_preinscripcio(schools, n_years, n_ensenyaments, max_levels, rng),
+        ESCOLES_ID: make_escoles(schools, n_years, rng),
+    }
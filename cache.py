@@ -0,0 +1,316 @@
+"""
+Cache of serialized datasets shared by the app processes, so that replicas behind a
+load balancer fetch and preprocess each dataset once between them instead of once each.
+
+The backend is chosen by a URL (ESCOLES_CACHE_URL):
+
+- ``memory://``: a dict in this process, mostly useful for development.
+- ``sqlite:///path/to/cache.sqlite``: a SQLite file shared by the processes of one host.
+- ``redis://host:6379/0``: a Redis-compatible server shared by every replica (needs
+  the optional ``redis`` package).
+
+Every URL accepts a ``max_bytes`` query parameter; past it the least recently used
+entries are evicted. Entries also expire after the ttl they were stored with.
+
+``get_or_compute`` is single-flight: on a miss it takes a lock on the key, so only
+one process computes a given entry while the others wait and then read its result.
+"""
+import contextlib
+import hashlib
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
+
+from telemetry import count, log_event
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+DEFAULT_MAX_BYTES = 512 * 2 ** 20
+LOCK_TIMEOUT = 600  # seconds a lock is held at most, and waited for at most
+LOCK_POLL_INTERVAL = 0.2  # seconds between attempts to take a lock held elsewhere
+
+def make_key(namespace, *parts):
+    # Short stable key from any repr-able parts, e.g. a URL and a query dict
+    return f"{namespace}:{hashlib.sha1(repr(parts).encode()).hexdigest()}"
+
+class MemoryCache:
+    """
+    Entries kept in this process, in least recently used order.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._size = 0
+        self._mutex = threading.Lock()
+        self._locks = defaultdict(threading.Lock)
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._size -= len(value)
+
+    def get(self, key):
+        with self._mutex:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        with self._mutex:
+            if key in self._entries:
+                self._remove(key)
+            now = time.time()
+            self._entries[key] = (now + ttl, value)
+            self._size += len(value)
+            if self._size > self.max_bytes:
+                # Expired entries go first, wherever they are in the LRU order
+                for old_key in [old_key for old_key, (expires, _) in self._entries.items() if expires < now]:
+                    self._remove(old_key)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    @contextlib.contextmanager
+    def lock(self, key, timeout=LOCK_TIMEOUT):
+        with self._mutex:
+            lock = self._locks[key]
+        acquired = lock.acquire(timeout=timeout)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+
+class SQLiteCache:
+    """
+    Entries in a SQLite file, shared by every process that opens the same path.
+
+    Locks are rows with a lease, so a process that dies while computing only blocks
+    the others until the lease expires. Keep the file on a local disk: SQLite locking
+    is unreliable on network filesystems, use Redis to share across hosts.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, size INTEGER, expires REAL, accessed REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, token TEXT, expires REAL)')
+
+    @contextlib.contextmanager
+    def _connection(self):
+        # One connection per thread, in autocommit mode unless a transaction is opened
+        if getattr(self._local, 'db', None) is None:
+            self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        yield self._local.db
+
+    def get(self, key):
+        now = time.time()
+        with self._connection() as db:
+            row = db.execute('SELECT value, expires FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                db.execute('DELETE FROM entries WHERE key = ? AND expires < ?', (key, now))
+                return None
+            db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            return row[0]
+
+    def set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        now = time.time()
+        with self._connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', (key, value, len(value), now + ttl, now))
+                db.execute('DELETE FROM entries WHERE expires < ?', (now,))
+                size = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+                if size > self.max_bytes:
+                    for old_key, old_size in db.execute('SELECT key, size FROM entries WHERE key != ? ORDER BY accessed', (key,)).fetchall():
+                        db.execute('DELETE FROM entries WHERE key = ?', (old_key,))
+                        size -= old_size
+                        if size <= self.max_bytes:
+                            break
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    @contextlib.contextmanager
+    def lock(self, key, timeout=LOCK_TIMEOUT):
+        token = uuid.uuid4().hex
+        deadline = time.time() + timeout
+        acquired = False
+        with self._connection() as db:
+            while True:
+                now = time.time()
+                db.execute('INSERT INTO locks VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET token = excluded.token, expires = excluded.expires '
+                           'WHERE locks.expires < ?', (key, token, now + timeout, now))
+                acquired = db.execute('SELECT token FROM locks WHERE key = ?', (key,)).fetchone()[0] == token
+                if acquired or now >= deadline:
+                    break
+                time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with self._connection() as db:
+                    db.execute('DELETE FROM locks WHERE key = ? AND token = ?', (key, token))
+
+class RedisCache:
+    """
+    Entries in a Redis-compatible server, shared by every replica.
+
+    Expiry is left to the server; the access times and sizes of the entries are kept
+    in a sorted set and a hash so that the least recently used ones are evicted past
+    ``max_bytes``. ``client`` can be any object with the redis-py interface, such as
+    the in-process benchmarks.fake_redis.FakeRedis.
+    """
+    _RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url=None, client=None, max_bytes=DEFAULT_MAX_BYTES, prefix='escoles:'):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("The redis package is needed for redis:// cache URLs.")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self._accessed = f"{prefix}accessed"
+        self._sizes = f"{prefix}sizes"
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.client.zrem(self._accessed, key)
+            self.client.hdel(self._sizes, key)
+            return None
+        self.client.zadd(self._accessed, {key: time.time()})
+        return value
+
+    def set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        pipeline = self.client.pipeline()
+        pipeline.set(self.prefix + key, value, px=int(ttl * 1000))
+        pipeline.zadd(self._accessed, {key: time.time()})
+        pipeline.hset(self._sizes, key, len(value))
+        pipeline.execute()
+
+        sizes = {k.decode() if isinstance(k, bytes) else k: int(v) for k, v in self.client.hgetall(self._sizes).items()}
+        # The server expires entries on its own; drop the bookkeeping of those before adding up
+        pipeline = self.client.pipeline()
+        for old_key in sizes:
+            pipeline.exists(self.prefix + old_key)
+        expired = [old_key for old_key, exists in zip(list(sizes), pipeline.execute()) if not exists]
+        if expired:
+            self.client.zrem(self._accessed, *expired)
+            self.client.hdel(self._sizes, *expired)
+            for old_key in expired:
+                del sizes[old_key]
+        size = sum(sizes.values())
+        for old_key in self.client.zrange(self._accessed, 0, -1):
+            if size <= self.max_bytes:
+                break
+            old_key = old_key.decode() if isinstance(old_key, bytes) else old_key
+            if old_key == key:
+                continue
+            self.client.delete(self.prefix + old_key)
+            self.client.zrem(self._accessed, old_key)
+            self.client.hdel(self._sizes, old_key)
+            size -= sizes.get(old_key, 0)
+
+    @contextlib.contextmanager
+    def lock(self, key, timeout=LOCK_TIMEOUT):
+        name = f"{self.prefix}lock:{key}"
+        token = uuid.uuid4().hex
+        deadline = time.time() + timeout
+        while not (acquired := bool(self.client.set(name, token, nx=True, px=int(timeout * 1000)))) and time.time() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.client.eval(self._RELEASE, 1, name, token)
+
+def open_cache(url):
+    """
+    The cache backend of a URL (see the module docstring), or None for an empty URL.
+    """
+    if not url:
+        return None
+    parsed = urlparse(url)
+    params = parse_qs(parsed.query)
+    max_bytes = int(params.pop('max_bytes', [DEFAULT_MAX_BYTES])[0])
+
+    if parsed.scheme == 'memory':
+        return MemoryCache(max_bytes)
+    if parsed.scheme == 'sqlite':
+        return SQLiteCache(parsed.netloc + parsed.path, max_bytes)
+    if parsed.scheme in ('redis', 'rediss'):
+        return RedisCache(urlunparse(parsed._replace(query=urlencode(params, doseq=True))), max_bytes=max_bytes)
+    raise ValueError(f"Unsupported cache URL: {url}")
+
+def get_or_compute(cache, key, compute, ttl, dumps, loads, store=None):
+    """
+    The cached value of ``key``, or the result of ``compute()`` stored for ``ttl`` seconds.
+
+    Args:
+    - cache: A backend from open_cache, or None to always compute.
+    - key: The key of the entry.
+    - compute: Function returning the value on a miss.
+    - ttl: Seconds the entry is kept.
+    - dumps, loads: Convert the value to bytes and back.
+    - store: Predicate on the computed value, False to not store it (e.g. an empty result).
+
+    A failing backend is logged and bypassed, so the value is then computed locally.
+    """
+    if cache is None:
+        return compute()
+    count('cache_calls.shared')
+
+    def cached():
+        try:
+            value = cache.get(key)
+        except Exception as e:
+            log_event('cache_error', key=key, operation='get', error=repr(e))
+            return None
+        return None if value is None else loads(value)
+
+    result = cached()
+    if result is not None:
+        return result
+
+    with contextlib.ExitStack() as stack:
+        try:
+            stack.enter_context(cache.lock(key))
+        except Exception as e:
+            log_event('cache_error', key=key, operation='lock', error=repr(e))
+        # Computed by another process while this one waited for the lock
+        result = cached()
+        if result is not None:
+            return result
+
+        count('cache_misses.shared')
+        result = compute()
+        if store is None or store(result):
+            try:
+                cache.set(key, dumps(result), ttl)
+            except Exception as e:
+                log_event('cache_error', key=key, operation='set', error=repr(e))
+    return result
@@ -1,78 +1,1059 @@
 import streamlit as st
+import streamlit.logger
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import bisect
+import contextvars
+import functools
+import hashlib
+import io
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
 import requests
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+from urllib.parse import urlencode, urlparse
 import pydeck as pdk
 import plotly.express as px
 import plotly.graph_objects as go
 from streamlit_extras.buy_me_a_coffee import button 
+import cache
+import telemetry
+from telemetry import count, finish_trace, span, start_trace
 
-# Define the fetch_data function with st.cache_data for caching
-@st.cache_data
+# Copy-on-Write (always on from pandas 3): slices of the shared dataset can never modify it
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
 
+# Socrata paging defaults: rows per page and concurrent page downloads
+PAGE_SIZE = 1000
+MAX_WORKERS = 8
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5  # seconds, doubled on every retry
+REQUEST_TIMEOUT = 60
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes handed to the CSV parser at a time
+# Columns whose type must not be inferred: codes such as '08000000' would lose their leading zero, and
+# a page of phone numbers without spaces would be read as integers while the others are text
+CSV_COLUMN_TYPES = {'codi_centre': pa.string(), 'codi_postal': pa.string(), 'tel_fon': pa.string()}
 
+# Local Parquet snapshots of the datasets, refreshed with the rows changed since the last sync
+SNAPSHOT_DIR = os.environ.get('ESCOLES_SNAPSHOT_DIR', '.snapshots')
+SNAPSHOT_SYNC_INTERVAL = 3600  # seconds between delta syncs of a running process
+SNAPSHOT_SYSTEM_FIELDS = ':id, :updated_at'
+SNAPSHOT_UPDATED_AT_KEY = b'escoles.updated_at'
 
-def fetch_data(url, limit=1000):
+# Prepared datasets published by ingest.py for every app process to memory-map
+ARTIFACT_DIR = os.environ.get('ESCOLES_ARTIFACT_DIR', 'artifacts')
+ARTIFACT_PREFIX = 'escoles-'
+ARTIFACT_POINTER = 'CURRENT'
+ARTIFACT_VERSION_KEY = b'escoles.version'
+ARTIFACTS_KEPT = 3
+
+# Background refresh of the datasets while sessions keep being served the current ones
+REFRESH_INTERVAL = int(os.environ.get('ESCOLES_REFRESH_INTERVAL', SNAPSHOT_SYNC_INTERVAL))  # seconds
+REFRESH_RETRY_INTERVAL = 60  # seconds before retrying a failed refresh
+
+# Cache shared by the app replicas (see cache.py), e.g. redis://cache:6379/0; empty to keep caching per process
+CACHE_URL = os.environ.get('ESCOLES_CACHE_URL', '')
+
+PREINSCRIPCIO_URL = os.environ.get('ESCOLES_PREINSCRIPCIO_URL', "https://analisi.transparenciacatalunya.cat/resource/99md-r3rq.csv")
+ESCOLES_URL = os.environ.get('ESCOLES_ESCOLES_URL', "https://analisi.transparenciacatalunya.cat/resource/kvmv-ahh4.csv")
+
+def build_query_url(url, query=None, **params):
+    # Encode SoQL parameters, keeping the characters SoQL uses readable in the URL
+    return f"{url}?{urlencode({**(query or {}), **params}, safe='$:*(),')}"
+
+def build_paginated_url(url, limit, offset, query=None):
+    # Order by the Socrata row id (unless told otherwise) so that every page range is stable across requests
+    query = {'$order': ':id', **(query or {})}
+    return build_query_url(url, query, **{'$limit': limit, '$offset': offset})
+
+def create_session(max_workers=MAX_WORKERS):
+    # Keep-alive session whose connection pool is large enough for every worker
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+class FetchError(RuntimeError):
+    # A dataset could not be downloaded completely from Socrata
+    pass
+
+def get_with_retry(session, url, retries=MAX_RETRIES, backoff=RETRY_BACKOFF, read=None):
+    """
+    GET a URL, retrying connection errors, 429 and 5xx responses with exponential backoff.
+
+    Returns the response, or None when every attempt failed. With ``read`` set the body
+    is streamed and ``read(response)`` is returned instead; a body that breaks off or
+    cannot be parsed is retried like a failed request.
+    """
+    for attempt in range(retries + 1):
+        try:
+            response = session.get(url, timeout=REQUEST_TIMEOUT, stream=read is not None)
+            if response.status_code == 200:
+                if read is None:
+                    return response
+                with response:
+                    return read(response)
+            response.close()
+            print(f"Failed to fetch data: {response.status_code} ({url})")
+            # Other client errors will not go away by asking again
+            if response.status_code < 500 and response.status_code != 429:
+                return None
+        except (requests.RequestException, pa.ArrowInvalid) as e:
+            print(f"Failed to fetch data: {e} ({url})")
+
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+
+    return None
+
+class ResponseStream(io.RawIOBase):
+    """
+    Read-only file object over ``response.iter_content`` so the CSV parser can consume
+    the body chunk by chunk instead of from one fully decoded string.
+    """
+
+    def __init__(self, response, chunk_size=STREAM_CHUNK_SIZE):
+        self._chunks = response.iter_content(chunk_size=chunk_size)
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+def read_csv_stream(response):
+    """
+    Parse the response body into an Arrow table incrementally while it is being downloaded.
+
+    Socrata answers past the last row with an empty body (or only the header), which
+    gives an empty table. Any other body that is not valid CSV raises pa.ArrowInvalid,
+    and a connection that breaks off raises a requests exception.
+    """
+    with io.BufferedReader(ResponseStream(response)) as stream:
+        if not stream.peek(1):
+            return pa.table({})
+        # Quoted Socrata text fields (addresses, names) may contain line breaks
+        return pa_csv.read_csv(stream, parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+                               convert_options=pa_csv.ConvertOptions(column_types=CSV_COLUMN_TYPES))
+
+def fetch_row_count(session, url, query=None, retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+    # Ask Socrata for the number of rows so that the page ranges are known up front
+    where = {'$where': query['$where']} if query and '$where' in query else {}
+    response = get_with_retry(session, build_query_url(url, where, **{'$select': 'count(*)'}), retries, backoff)
+    if response is None:
+        return None
+    try:
+        return int(pd.read_csv(StringIO(response.text)).iloc[0, 0])
+    except (ValueError, IndexError, pd.errors.ParserError):
+        return None
+
+def fetch_page(session, url, limit, offset, query=None, retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+    # Download one page as an Arrow table; returns None when it could not be fetched and parsed
+    with span('fetch_page', url=url, offset=offset):
+        data = get_with_retry(session, build_paginated_url(url, limit, offset, query), retries, backoff, read=read_csv_stream)
+        if data is not None:
+            count('pages_fetched')
+        return data
+
+def unify_page_types(tables):
+    """
+    Read as text, in every page, the columns whose inferred types can't be promoted to a
+    common one (numbers in one page, text in another).
+
+    Each page is typed on its own, so a column that is not in CSV_COLUMN_TYPES can
+    still come out as int64 in a page and as string in the next.
+    """
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            types.setdefault(field.name, set()).add(field.type)
+    text = set()
+    for name, found in types.items():
+        try:
+            pa.unify_schemas([pa.schema([pa.field(name, type_)]) for type_ in found], promote_options='permissive')
+        except pa.ArrowTypeError:
+            text.add(name)
+    unified = []
+    for table in tables:
+        for name in text & set(table.column_names):
+            table = table.set_column(table.schema.get_field_index(name), name, table[name].cast(pa.string()))
+        unified.append(table)
+    return unified
+
+def concat_pages(pages):
+    """
+    Build the DataFrame from all the downloaded pages in a single step.
+
+    The pages are kept as Arrow tables, which are concatenated without copying and
+    converted to pandas once. Growing a DataFrame page by page copies everything
+    downloaded so far on every page, and holding hundreds of small DataFrames
+    fragments the heap.
+    """
+    tables = [table for table in pages if table.num_rows]
+    if not tables:
+        return pd.DataFrame()
+    # A column can be inferred as null in one page and as a real type in another
+    return pa.concat_tables(unify_page_types(tables), promote_options='permissive').to_pandas()
+
+def fetch_data_sequential(session, url, query, limit, retries, backoff):
     offset = 0
-    all_data = pd.DataFrame()
+    pages = []
 
     while True:
-        # Correctly build the URL with limit and offset
-        paginated_url = f"{url}?$limit={limit}&$offset={offset}"
-        response = requests.get(paginated_url)
-
-        if response.status_code == 200:
-            # Use StringIO to convert the text data into a DataFrame
-            data = pd.read_csv(StringIO(response.text))
-            
-            # If no data is returned, we've reached the end of the dataset
-            if data.empty:
-                break
-            
-            # Concatenate the fetched data with the existing DataFrame
-            all_data = pd.concat([all_data, data], ignore_index=True)
-            
-            # Increase the offset for the next iteration
-            offset += limit
-        else:
-            print(f"Failed to fetch data: {response.status_code}")
+        data = fetch_page(session, url, limit, offset, query, retries, backoff)
+        if data is None:
+            raise FetchError(f"Could not fetch the page at offset {offset} of {url}")
+
+        # If no data is returned, we've reached the end of the dataset
+        if data.num_rows == 0:
             break
 
-    return all_data
+        pages.append(data)
+
+        # Increase the offset for the next iteration
+        offset += limit
+
+    return concat_pages(pages)
+
+def fetch_data_parallel(session, url, query, limit, max_workers, total_rows, retries, backoff):
+    offsets = range(0, total_rows, limit)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Each page runs in a copy of the caller's context so that its spans reach the caller's trace
+        futures = [executor.submit(contextvars.copy_context().run, fetch_page, session, url, limit, offset, query, retries, backoff)
+                   for offset in offsets]
+        # Collect the pages in offset order, whatever order they finish in
+        pages = [future.result() for future in futures]
+
+    # A missing page fails the whole download rather than leaving a hole in the result
+    missing = [offset for offset, data in zip(offsets, pages) if data is None]
+    if missing:
+        raise FetchError(f"Could not fetch {len(missing)} of {len(pages)} pages of {url}")
+    return concat_pages(pages)
+
+def fetch_data(url, query=None, limit=PAGE_SIZE, max_workers=MAX_WORKERS, parallel=True, retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+    """
+    Download a whole Socrata dataset as a DataFrame.
+
+    When ``parallel`` is set, the row count is requested first and the page ranges are
+    downloaded concurrently by ``max_workers`` threads sharing one keep-alive session.
+    Without a row count (or with ``parallel=False``) pages are fetched one after another
+    until an empty page comes back.
+
+    Raises FetchError when a page still fails after its retries (error status, broken
+    connection or a body that is not valid CSV), so that a partial download is never
+    mistaken for the whole dataset.
+
+    Args:
+    - url: The Socrata CSV resource URL.
+    - query: Optional dict of extra SoQL parameters (``$select``, ``$where``, ``$order``).
+    - limit: Number of rows per page.
+    - max_workers: Maximum number of pages downloaded at the same time.
+    - parallel: Whether to download the pages concurrently.
+    - retries: How many times a failed page is retried.
+    - backoff: Initial delay in seconds between retries, doubled each time.
+    """
+    with create_session(max_workers) as session:
+        total_rows = fetch_row_count(session, url, query, retries, backoff) if parallel else None
+
+        if total_rows is None:
+            return fetch_data_sequential(session, url, query, limit, retries, backoff)
+
+        return fetch_data_parallel(session, url, query, limit, max_workers, total_rows, retries, backoff)
+
+def snapshot_path(url, query=None):
+    # One Parquet file per Socrata dataset and query, named after the dataset id (e.g. 99md-r3rq)
+    dataset_id = os.path.splitext(os.path.basename(urlparse(url).path))[0]
+    if query:
+        query_hash = hashlib.sha1(json.dumps(query, sort_keys=True).encode()).hexdigest()[:8]
+        dataset_id = f"{dataset_id}-{query_hash}"
+    return os.path.join(SNAPSHOT_DIR, f"{dataset_id}.parquet")
+
+def snapshot_query(query, updated_at=None):
+    """
+    Extend a dataset query so it also returns the system fields used for syncing and,
+    given the last synced ``updated_at``, only the rows changed since then.
+    """
+    query = dict(query or {})
+    query['$select'] = f"{SNAPSHOT_SYSTEM_FIELDS}, {query.get('$select', '*')}"
+    if updated_at is not None:
+        changed = f":updated_at > '{updated_at}'"
+        query['$where'] = f"({query['$where']}) AND {changed}" if '$where' in query else changed
+        # Page in update order so an interrupted download still leaves no gaps before the last row kept
+        query['$order'] = ':updated_at, :id'
+    return query
+
+def read_snapshot(url, query=None):
+    """
+    Read the local snapshot of a dataset.
+
+    Returns the DataFrame (including the ``:id`` and ``:updated_at`` system fields) and
+    the last ``:updated_at`` it contains, or (None, None) when there is no usable snapshot.
+    """
+    path = snapshot_path(url, query)
+    if not os.path.exists(path):
+        return None, None
+    try:
+        table = pq.read_table(path)
+    except (OSError, pa.ArrowInvalid) as e:
+        print(f"Ignoring unreadable snapshot {path}: {e}")
+        return None, None
+    updated_at = (table.schema.metadata or {}).get(SNAPSHOT_UPDATED_AT_KEY)
+    if updated_at is None:
+        return None, None
+    # Snapshots written before a column type was pinned are downloaded again (pandas writes strings back as large_string)
+    if any(name in table.column_names and table.schema.field(name).type not in (type_, pa.large_string() if type_ == pa.string() else type_)
+           for name, type_ in CSV_COLUMN_TYPES.items()):
+        print(f"Ignoring outdated snapshot {path}")
+        return None, None
+    return table.to_pandas(), updated_at.decode()
+
+def write_snapshot(url, query, df, updated_at):
+    # Write to a temporary file and rename it over the old one so readers never see a partial file
+    path = snapshot_path(url, query)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), SNAPSHOT_UPDATED_AT_KEY: updated_at.encode()})
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+def last_updated_at(df):
+    # Latest :updated_at in the frame, formatted as a SoQL floating timestamp literal
+    return pd.to_datetime(df[':updated_at'], utc=True).max().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+
+def sync_snapshot(url, query=None):
+    """
+    Bring the local snapshot of a dataset (restricted to ``query``) up to date and return it.
+
+    Without a snapshot the whole dataset is downloaded. Otherwise only the rows whose
+    ``:updated_at`` is newer than the snapshot are requested and merged in by ``:id``.
+    If the merged row count then differs from the remote one (rows were deleted
+    upstream) the dataset is downloaded again in full.
 
-def preprocess_school_data(df, escoles_raw):
+    Raises FetchError when Socrata fails, leaving the snapshot as it was; the
+    DatasetRefresher then keeps serving the dataset built from it.
+    """
+    snapshot, updated_at = read_snapshot(url, query)
+
+    if snapshot is not None:
+        delta = fetch_data(url, query=snapshot_query(query, updated_at))
+        if delta.empty:
+            merged = snapshot
+        else:
+            merged = pd.concat([snapshot[~snapshot[':id'].isin(delta[':id'])], delta], ignore_index=True)
+
+        with create_session() as session:
+            remote_rows = fetch_row_count(session, url, query)
+        if remote_rows is None or remote_rows == len(merged):
+            if not delta.empty:
+                write_snapshot(url, query, merged, last_updated_at(merged))
+            return merged
+
+    full = fetch_data(url, query=snapshot_query(query))
+    if full.empty:
+        return snapshot if snapshot is not None else full
+    write_snapshot(url, query, full, last_updated_at(full))
+    return full
+
+def snapshot_stamp(df):
+    # Identifies the content of a synced frame: its latest :updated_at and its row count
+    return f"{last_updated_at(df)}/{len(df)}" if ':updated_at' in df and len(df) else ''
+
+def sync_dataset(url, query=None):
+    """
+    Sync the on-disk snapshot and drop the Socrata system fields used for syncing.
+
+    Returns the DataFrame and the snapshot_stamp of its content.
+    """
+    with span('fetch', url=url):
+        df = sync_snapshot(url, query)
+    return df.drop(columns=[':id', ':updated_at'], errors='ignore'), snapshot_stamp(df)
+
+# The process opens the backend once; it is also used from the refresh thread, outside any session
+@functools.lru_cache(maxsize=None)
+def shared_cache():
+    return cache.open_cache(CACHE_URL)
+
+def load_dataset(url, query=None):
+    # Read through the shared cache, so that a single replica syncs each dataset per interval; the stamp travels as the version
+    return cache.get_or_compute(
+        shared_cache(), cache.make_key('synced', url, query), lambda: sync_dataset(url, query), SNAPSHOT_SYNC_INTERVAL,
+        dumps=lambda frame: frame_to_ipc(*frame), loads=lambda data: frame_from_ipc(pa.BufferReader(data)), store=lambda frame: not frame[0].empty,
+    )
+
+# Year of the school directory (kvmv-ahh4) used for addresses, contacts and coordinates
+SCHOOL_DIRECTORY_YEAR = '2023'
+
+# What preprocess_school_data and the views need from each dataset, pushed down into the Socrata query
+PREINSCRIPCIO_QUERY = {
+    '$select': 'codi_centre, denominaci_completa, nom_naturalesa, nom_municipi, nom_comarca, '
+               'nom_ensenyament, curs, nivell, oferta_inicial_places, assignacions_1a_peticio, '
+               'assignacions_altres_peticions',
+}
+ESCOLES_QUERY = {
+    '$select': 'codi_centre, any, adre_a, tel_fon, e_mail_centre, url, coordenades_geo_x, coordenades_geo_y',
+    '$where': f"any = '{SCHOOL_DIRECTORY_YEAR}'",
+}
+
+# Compact dtypes for the merged school DataFrame: the labels repeated on every row of a school
+# become categoricals, the counts small nullable integers and the coordinates float32
+SCHOOL_SCHEMA = {
+    'codi_centre': 'category',
+    'denominaci_completa': 'category',
+    'nom_naturalesa': 'category',
+    'nom_municipi': 'category',
+    'nom_comarca': 'category',
+    'nom_ensenyament': 'category',
+    'curs': 'category',
+    'nivell': 'Int8',
+    'oferta_inicial_places': 'Int16',
+    'assignacions_1a_peticio': 'Int16',
+    'assignacions_altres_peticions': 'Int16',
+    'adre_a': 'category',
+    'tel_fon': 'category',
+    'e_mail_centre': 'category',
+    'url': 'category',
+    'coordenades_geo_x': 'float32',
+    'coordenades_geo_y': 'float32',
+    'school_with_municipality': 'category',
+    'address': 'category',
+}
+
+def apply_schema(df, schema):
+    # Cast the columns of df that appear in the schema, leaving any other column untouched
+    return df.astype({column: dtype for column, dtype in schema.items() if column in df.columns})
+
+def memory_report(before, after):
+    """
+    Compare the memory used by each column of two versions of the same DataFrame.
+
+    Args:
+    - before: The DataFrame with its original dtypes.
+    - after: The same DataFrame after applying a schema.
+
+    Returns a DataFrame with the bytes per column before and after, their ratio and a total row.
+    """
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'dtype_after': after.dtypes.astype(str),
+        'bytes_before': before.memory_usage(index=False, deep=True),
+        'bytes_after': after.memory_usage(index=False, deep=True),
+    })
+    report.loc['total', ['bytes_before', 'bytes_after']] = report[['bytes_before', 'bytes_after']].sum()
+    report['ratio'] = report['bytes_after'] / report['bytes_before']
+    return report
+
+def preprocess_school_data(df, escoles_raw, schema=SCHOOL_SCHEMA):
+    # Every step returns a new frame: the inputs may be cached or shared and are never modified
     # Ensure 'codi_centre' and 'any' are of string type in both DataFrames
-    df['codi_centre'] = df['codi_centre'].astype(str)
-    escoles_raw['codi_centre'] = escoles_raw['codi_centre'].astype(str)
-    escoles_raw['any'] = escoles_raw['any'].astype(str)
+    df = df.assign(codi_centre=df['codi_centre'].astype(str))
+    escoles_raw = escoles_raw.assign(codi_centre=escoles_raw['codi_centre'].astype(str), any=escoles_raw['any'].astype(str))
     
-    # Filter the escoles_raw DataFrame for rows where 'any' is '2023'
-    escoles = escoles_raw[escoles_raw['any'] == '2023']
+    # Filter the escoles_raw DataFrame for rows of the directory year (ESCOLES_QUERY already asks only for those)
+    escoles = escoles_raw[escoles_raw['any'] == SCHOOL_DIRECTORY_YEAR]
 
     # Rename columns in df to avoid name clashes during merge
-    df.rename(columns={
+    df = df.rename(columns={
         'coordenades_geo_x': 'coordenades_geo_x_2',
         'coordenades_geo_y': 'coordenades_geo_y_2'
-    }, inplace=True)
+    })
     
     # Merge df with escoles on 'codi_centre', keeping all rows from df and adding matching rows from escoles
     df = pd.merge(df, escoles[['codi_centre', 'adre_a', 'tel_fon', 'e_mail_centre', 'url', 'coordenades_geo_x', 'coordenades_geo_y']],
                   on='codi_centre', how='left')
     
     # Fill missing values for specific columns
-    df['coordenades_geo_x'].fillna(value=0, inplace=True)  # Replace 0 with a more sensible default if available
-    df['coordenades_geo_y'].fillna(value=0, inplace=True)  # Replace 0 with a more sensible default if available
-    df['url'] = df['url'].fillna('')
-    df['tel_fon'] = df['tel_fon'].fillna('')
-    df['adre_a'] = df['adre_a'].fillna('')
-    df['e_mail_centre'] = df['adre_a'].fillna('')
-    df['codi_centre'] = df['adre_a'].fillna('')
+    df = df.fillna({
+        'coordenades_geo_x': 0,  # Replace 0 with a more sensible default if available
+        'coordenades_geo_y': 0,  # Replace 0 with a more sensible default if available
+        'url': '',
+        'tel_fon': '',
+        'adre_a': '',
+        'e_mail_centre': '',
+    })
         
-    df['school_with_municipality'] = df['denominaci_completa'] + ' (' + df['nom_municipi'] + ')'
-    df['address'] = df['nom_municipi'] + ', ' + df['nom_comarca']  # Replace 'additional_address_info' with the actual column name
+    df = df.assign(
+        school_with_municipality=df['denominaci_completa'] + ' (' + df['nom_municipi'] + ')',
+        address=df['nom_municipi'] + ', ' + df['nom_comarca'],  # Replace 'additional_address_info' with the actual column name
+    )
     
+    # Compact the dtypes once the string columns have been derived
+    if schema is not None:
+        df = apply_schema(df, schema)
+
     return df
 
+# Spatial lookups of nearby schools
+EARTH_RADIUS = 6_371_000  # metres
+GRID_CELL_DEGREES = 0.01  # about 1.1 km of latitude per grid cell
+CLOSEST_SCHOOLS = 10  # rows of the closest schools table
+
+# Memoized plotly figures kept per process
+FIGURE_CACHE_SIZE = 512
+
+# School search: matches offered per query
+SEARCH_RESULTS = 20
+
+# Demand ranking: schools listed at each end and the areas it can be restricted to
+RANKING_SIZE = 10
+RANKING_SCOPES = {'Municipi': 'nom_municipi', 'Comarca': 'nom_comarca'}
+
+# Base map layer of every school, published once per dataset version as a static file
+# (served by Streamlit under app/static/ when server.enableStaticServing is on). The
+# directory is only overridden where nothing serves it, such as the benchmarks.
+STATIC_DIR = os.environ.get('ESCOLES_STATIC_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+STATIC_URL = 'app/static'
+SCHOOL_POINTS_PREFIX = 'school-points-'
+SCHOOL_POINTS_KEPT = 3
+
+def haversine(lat, lon, lats, lons):
+    # Great-circle distance in metres from one point to arrays of points
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+class SchoolSpatialIndex:
+    """
+    Grid index over school coordinates answering within-radius and k-nearest queries
+    by haversine distance.
+
+    Points are bucketed into square cells of ``cell_degrees``; a query only measures
+    the points of the cells overlapping the bounding box of its radius.
+    """
+
+    def __init__(self, lats, lons, cell_degrees=GRID_CELL_DEGREES):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cell_degrees = cell_degrees
+
+        # Sort the points by cell so that each cell is a contiguous slice of self.order
+        cells = self._cells(self.lats, self.lons)
+        self.order = np.lexsort((cells[1], cells[0]))
+        sorted_cells = cells[:, self.order]
+        boundaries = np.flatnonzero(np.any(np.diff(sorted_cells, axis=1), axis=0)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(self.order)]))
+        self.cells = {(sorted_cells[0, start], sorted_cells[1, start]): (start, end)
+                      for start, end in zip(starts, ends) if end > start}
+        # Range of the occupied cells, beyond which a larger search finds nothing new
+        occupied = np.array(list(self.cells)).reshape(-1, 2)
+        self.cell_bounds = (occupied.min(axis=0), occupied.max(axis=0)) if len(occupied) else None
+
+    def _cells(self, lats, lons):
+        return np.floor(np.vstack((lats, lons)) / self.cell_degrees).astype(np.int64)
+
+    def _box(self, lat, lon, radius):
+        # Lowest and highest (lat, lon) cell of the bounding box of the radius
+        dlat = np.degrees(radius / EARTH_RADIUS)
+        dlon = dlat / max(np.cos(np.radians(lat)), 1e-6)
+        return self._cells(np.array([lat - dlat, lat + dlat]), np.array([lon - dlon, lon + dlon])).T
+
+    def within_radius(self, lat, lon, radius):
+        """
+        Points within ``radius`` metres of (lat, lon).
+
+        Returns the point positions and their distances, sorted by distance.
+        """
+        (lat_min, lon_min), (lat_max, lon_max) = self._box(lat, lon, radius)
+
+        if (lat_max - lat_min + 1) * (lon_max - lon_min + 1) > len(self.cells):
+            # A box with more cells than are occupied is cheaper to check the other way round
+            slices = [cell for (i, j), cell in self.cells.items() if lat_min <= i <= lat_max and lon_min <= j <= lon_max]
+        else:
+            slices = [self.cells.get((i, j)) for i in range(lat_min, lat_max + 1) for j in range(lon_min, lon_max + 1)]
+            slices = [cell for cell in slices if cell is not None]
+        if not slices:
+            return np.array([], dtype=np.int64), np.array([])
+        candidates = np.concatenate([self.order[start:end] for start, end in slices])
+
+        distances = haversine(lat, lon, self.lats[candidates], self.lons[candidates])
+        inside = distances <= radius
+        candidates, distances = candidates[inside], distances[inside]
+        by_distance = np.argsort(distances, kind='stable')
+        return candidates[by_distance], distances[by_distance]
+
+    def nearest(self, lat, lon, k):
+        """
+        The ``k`` points closest to (lat, lon), sorted by distance.
+
+        The search radius doubles until it holds ``k`` points; once its bounding box
+        covers every occupied cell, every point is measured instead.
+        """
+        if self.cell_bounds is None:
+            return np.array([], dtype=np.int64), np.array([])
+
+        radius = self.cell_degrees * 111_000
+        while True:
+            positions, distances = self.within_radius(lat, lon, radius)
+            if len(positions) >= k:
+                return positions[:k], distances[:k]
+            low, high = self._box(lat, lon, radius)
+            if np.all(low <= self.cell_bounds[0]) and np.all(high >= self.cell_bounds[1]):
+                break
+            radius *= 2
+
+        distances = haversine(lat, lon, self.lats, self.lons)
+        positions = np.argsort(distances, kind='stable')[:k]
+        return positions, distances[positions]
+
+def normalize_text(text):
+    """
+    Lowercase, accent-free form of a text for searching: 'Escola Pia de Sarrià' and
+    'escola pia de sarria' normalize alike. The Catalan middle dot is dropped so that
+    'col·legi' matches 'collegi', and any other punctuation separates words.
+    """
+    text = unicodedata.normalize('NFKD', str(text).lower().replace('·', '').replace('\u0140', 'l'))
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.findall(r'[a-z0-9]+', text))
+
+class SchoolSearchIndex:
+    """
+    Accent-insensitive lookup of schools by name, municipality or 'codi_centre'.
+
+    Every query word must match a word of the school, either as a prefix of it
+    ('sarr' finds 'Sarrià') or, from three letters on, anywhere inside the school's
+    text ('ramon' finds 'Josep-Ramon'). Prefix matches come first.
+    """
+
+    def __init__(self, ids, texts):
+        self.ids = list(ids)
+        self.texts = [normalize_text(text) for text in texts]
+
+        words = defaultdict(set)
+        trigrams = defaultdict(set)
+        for position, text in enumerate(self.texts):
+            for word in text.split():
+                words[word].add(position)
+            for start in range(len(text) - 2):
+                trigrams[text[start:start + 3]].add(position)
+        # Sorted words make every prefix a contiguous slice found by bisection
+        self.words = sorted(words)
+        self.word_positions = [frozenset(words[word]) for word in self.words]
+        self.trigrams = {trigram: frozenset(positions) for trigram, positions in trigrams.items()}
+
+    def _prefix_matches(self, term):
+        start = bisect.bisect_left(self.words, term)
+        end = bisect.bisect_left(self.words, term + '\uffff')
+        return frozenset().union(*self.word_positions[start:end])
+
+    def _substring_matches(self, term):
+        if len(term) < 3:
+            return frozenset()
+        candidates = frozenset.intersection(*(self.trigrams.get(term[i:i + 3], frozenset()) for i in range(len(term) - 2)))
+        return frozenset(position for position in candidates if term in self.texts[position])
+
+    def search(self, query, k=SEARCH_RESULTS):
+        """
+        The ids of at most ``k`` schools matching ``query``, best first. An empty
+        query returns the first ``k`` schools.
+        """
+        terms = normalize_text(query).split()
+        if not terms:
+            return self.ids[:k]
+        prefix = [self._prefix_matches(term) for term in terms]
+        by_prefix = frozenset.intersection(*prefix)
+        if len(by_prefix) >= k:
+            return [self.ids[position] for position in sorted(by_prefix)[:k]]
+        anywhere = frozenset.intersection(*(matches | self._substring_matches(term) for matches, term in zip(prefix, terms)))
+        ranked = sorted(by_prefix) + sorted(anywhere - by_prefix)
+        return [self.ids[position] for position in ranked[:k]]
+
+def build_demand_cube(df):
+    """
+    Aggregate the school rows into a demand cube with one row per
+    (codi_centre, nom_ensenyament, nivell, curs), sorted by that key.
+
+    Besides the school labels and the summed seats and assignments, each row holds:
+    - oversubscription: 1st choice assignments per seat offered.
+    - fill_rate: All assignments per seat offered.
+    - oversubscription_change: Change of oversubscription since the curs a year earlier
+      of the same level; NaN when that curs has no row (a gap in the data or the first curs).
+    - entry_level: Whether nivell is the lowest of the school's ensenyament, where families apply.
+
+    The ratios are NaN where no seats were offered.
+    """
+    key = ['codi_centre', 'nom_ensenyament', 'nivell', 'curs']
+    cube = df.groupby(key, observed=True, sort=True).agg(
+        denominaci_completa=('denominaci_completa', 'first'),
+        nom_municipi=('nom_municipi', 'first'),
+        nom_comarca=('nom_comarca', 'first'),
+        oferta_inicial_places=('oferta_inicial_places', 'sum'),
+        assignacions_1a_peticio=('assignacions_1a_peticio', 'sum'),
+        assignacions_altres_peticions=('assignacions_altres_peticions', 'sum'),
+    ).reset_index()
+
+    offer = cube['oferta_inicial_places'].to_numpy(dtype=float, na_value=np.nan)
+    offer[offer <= 0] = np.nan
+    first_choice = cube['assignacions_1a_peticio'].to_numpy(dtype=float, na_value=np.nan)
+    other = cube['assignacions_altres_peticions'].to_numpy(dtype=float, na_value=np.nan)
+    cube = cube.assign(
+        oversubscription=(first_choice / offer).astype(np.float32),
+        fill_rate=((first_choice + other) / offer).astype(np.float32),
+    )
+
+    # Rows are sorted by curs within each level, so the previous row of a level is its previous
+    # available curs; it only counts when it is the curs of the year before ('2022/2023' for '2023/2024')
+    levels = cube.groupby(key[:3], observed=True, sort=False)
+    year = pd.to_numeric(cube['curs'].astype(str).str[:4], errors='coerce')
+    previous_year = year.groupby([cube[column] for column in key[:3]], observed=True, sort=False).shift()
+    change = cube['oversubscription'] - levels['oversubscription'].shift()
+    return apply_schema(cube.assign(
+        oversubscription_change=change.where(year - previous_year == 1),
+        entry_level=(cube['nivell'] == cube.groupby(key[:2], observed=True, sort=False)['nivell'].transform('min')).fillna(False).astype(bool),
+    ), SCHOOL_SCHEMA)
+
+class PreparedDataset:
+    """
+    The merged school DataFrame together with lookup indexes built once per load, so
+    that selecting a school or a municipality is a dict lookup plus a positional slice
+    instead of a boolean scan of the whole frame.
+
+    Schools are identified by their 'codi_centre', which stays the same across renames.
+
+    Attributes:
+    - df: The preprocessed DataFrame.
+    - version: Identifies this build of the dataset, for keying derived caches.
+    - school_options: The 'codi_centre' values in order of appearance.
+    - school_labels: 'codi_centre' -> 'school_with_municipality', for display.
+    - school_rows: 'codi_centre' -> array of row positions in df.
+    - municipality_rows: 'nom_municipi' -> array of row positions in df.
+    - school_points: One row per school with known coordinates, for maps and distances.
+    - spatial_index: SchoolSpatialIndex over the coordinates of school_points.
+    - search_index: SchoolSearchIndex over the names, municipalities and codes of the schools.
+    - cube: The demand cube of build_demand_cube.
+    - cube_area_rows: 'nom_municipi' or 'nom_comarca' -> area -> array of row positions in cube.
+
+    One instance is shared by every session of the process, so it is treated as
+    read-only: lookups return new frames and never modify df.
+    """
+
+    def __init__(self, df, version=None):
+        self.df = df
+        self.version = version or f"{time.time_ns():x}"
+        self.school_rows = df.groupby('codi_centre', observed=True, sort=False).indices
+        self.municipality_rows = df.groupby('nom_municipi', observed=True, sort=False).indices
+        self.school_options = list(self.school_rows)
+
+        first_rows = df.iloc[[rows[0] for rows in self.school_rows.values()]]
+        self.school_labels = dict(zip(self.school_options, first_rows['school_with_municipality'].astype(str)))
+        self.search_index = SchoolSearchIndex(
+            self.school_options,
+            first_rows['denominaci_completa'].astype(str) + ' ' + first_rows['nom_municipi'].astype(str) + ' ' + first_rows['codi_centre'].astype(str),
+        )
+
+        # Missing coordinates are filled with (0, 0) by preprocess_school_data; keep them off the map
+        located = first_rows['coordenades_geo_x'].fillna(0).ne(0) & first_rows['coordenades_geo_y'].fillna(0).ne(0)
+        self.school_points = first_rows[located].reset_index(drop=True)
+        self.spatial_index = SchoolSpatialIndex(self.school_points['coordenades_geo_y'], self.school_points['coordenades_geo_x'])
+
+        self.cube = build_demand_cube(df)
+        self.cube_area_rows = {column: self.cube.groupby(column, observed=True, sort=True).indices for column in RANKING_SCOPES.values()}
+
+        for rows in itertools.chain(self.school_rows.values(), self.municipality_rows.values(),
+                                    *(area_rows.values() for area_rows in self.cube_area_rows.values())):
+            rows.flags.writeable = False
+
+    def school_label(self, code):
+        # Name and municipality of a school, for selectors
+        return self.school_labels.get(code, code)
+
+    def search(self, query, k=SEARCH_RESULTS):
+        # Codes of the schools matching a free-text query
+        return self.search_index.search(query, k)
+
+    def school(self, code):
+        # Rows of one school, or an empty frame when it is unknown
+        return self.df.iloc[self.school_rows.get(code, [])]
+
+    def schools(self, codes):
+        # Rows of several schools, in the order they are given
+        positions = [self.school_rows[code] for code in codes if code in self.school_rows]
+        return self.df.iloc[np.concatenate(positions) if positions else []]
+
+    def municipality(self, municipality):
+        # Rows of every school in a municipality
+        return self.df.iloc[self.municipality_rows.get(municipality, [])]
+
+    def areas(self, column):
+        # Names of the municipalities or comarques ('nom_municipi' or 'nom_comarca'), sorted
+        return list(self.cube_area_rows[column])
+
+    def area_cube(self, column, area):
+        # Demand cube rows of the schools of one municipality or comarca
+        return self.cube.iloc[self.cube_area_rows[column].get(area, [])]
+
+def dataset_version(*stamps):
+    # Version of a prepared dataset, derived from the snapshot_stamp of each source so that unchanged data keeps its version
+    return hashlib.sha1('|'.join(stamps).encode()).hexdigest()[:16]
+
+def prepare_school_frame(url, url2):
+    # The preprocessed school DataFrame and the version of its content
+    df, stamp = load_dataset(url, PREINSCRIPCIO_QUERY)
+    escoles_raw, stamp2 = load_dataset(url2, ESCOLES_QUERY)
+    with span('preprocess'):
+        return preprocess_school_data(df, escoles_raw), dataset_version(stamp, stamp2)
+
+def load_prepared_dataset(url, url2, current=None):
+    """
+    The PreparedDataset of the current data. The preprocessed frame goes through the
+    shared cache too, with its version so replicas agree on it.
+
+    When the version is that of ``current`` the data has not changed and ``current``
+    itself is returned, so that the caches keyed by version stay valid.
+    """
+    df, version = cache.get_or_compute(
+        shared_cache(), cache.make_key('prepared', url, url2), lambda: prepare_school_frame(url, url2), SNAPSHOT_SYNC_INTERVAL,
+        dumps=lambda frame: frame_to_ipc(*frame), loads=lambda data: frame_from_ipc(pa.BufferReader(data)), store=lambda frame: not frame[0].empty,
+    )
+    if current is not None and current.version == version:
+        return current
+    with span('build_indexes'):
+        return PreparedDataset(df, version)
+
+def load_snapshot_dataset(url, url2):
+    """
+    The PreparedDataset built from the local snapshots alone, without any request, or
+    None unless both datasets have one.
+    """
+    frames = [read_snapshot(dataset_url, query)[0] for dataset_url, query in ((url, PREINSCRIPCIO_QUERY), (url2, ESCOLES_QUERY))]
+    if any(frame is None for frame in frames):
+        return None
+    # The same version as a refresh finds if nothing changed since the snapshots
+    version = dataset_version(*(snapshot_stamp(frame) for frame in frames))
+    df, escoles_raw = (frame.drop(columns=[':id', ':updated_at'], errors='ignore') for frame in frames)
+    return PreparedDataset(preprocess_school_data(df, escoles_raw), version)
+
+class DatasetRefresher:
+    """
+    Keeps the PreparedDataset of the process current from a worker thread, so that
+    sessions are served the dataset they find and never wait for Socrata (stale while
+    revalidate).
+
+    At start the dataset is built from the local snapshots, when there are some, and
+    then refreshed right away. After that both datasets are synced and the dataset
+    rebuilt every ``interval`` seconds, and the new one replaces the old in a single
+    assignment: a rerun keeps the dataset it started with. When a refresh fails (e.g.
+    Socrata answers with errors) the current dataset, which is at worst the one of the
+    last good snapshots, stays and the refresh is retried after ``retry_interval``.
+
+    A refresh that finds the same data (same snapshot stamps) keeps the current
+    dataset and its version, so the caches keyed by version stay valid.
+
+    Attributes:
+    - last_refresh: time.time() of the last successful refresh, or None.
+    - last_error: The exception of the last refresh when it failed, otherwise None.
+    - last_refresh_summary: Dict with the 'duration_s' and the 'pages' fetched by the
+      last refresh attempt, recorded in a trace of its own, or None.
+    """
+
+    def __init__(self, url, url2, interval=REFRESH_INTERVAL, retry_interval=REFRESH_RETRY_INTERVAL):
+        self.url = url
+        self.url2 = url2
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.last_refresh = None
+        self.last_error = None
+        self.last_refresh_summary = None
+        self._dataset = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='escoles-refresh', daemon=True)
+        self._thread.start()
+
+    @property
+    def dataset(self):
+        # Only the very first sessions of a process without snapshots wait for the download
+        self._ready.wait()
+        return self._dataset
+
+    def refresh(self):
+        # The refresh thread is outside any rerun, so it records its own trace
+        trace = start_trace()
+        try:
+            with span('refresh'):
+                dataset = load_prepared_dataset(self.url, self.url2, self._dataset)
+        finally:
+            self.last_refresh_summary = {'duration_s': trace.elapsed(), 'pages': trace.counters['pages_fetched']}
+            finish_trace(trace, event='refresh')
+        if dataset.df.empty and self._dataset is not None:
+            raise FetchError("Socrata returned no rows")
+        self._dataset = dataset
+        self.last_refresh = time.time()
+        self.last_error = None
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        try:
+            with span('load_snapshot_dataset'):
+                self._dataset = load_snapshot_dataset(self.url, self.url2)
+        except Exception as e:
+            print(f"Ignoring the snapshots: {e!r}")
+        if self._dataset is not None:
+            self._ready.set()
+
+        while True:
+            try:
+                self.refresh()
+                delay = self.interval
+            except Exception as e:
+                print(f"Failed to refresh the datasets: {e!r}")
+                telemetry.log_event('refresh_error', error=repr(e))
+                self.last_error = e
+                delay = self.retry_interval
+            finally:
+                self._ready.set()
+            if self._stop.wait(delay):
+                return
+
+# Define the dataset_refresher function with st.cache_resource so the process runs a single refresh thread
+@st.cache_resource
+def dataset_refresher(url, url2):
+    return DatasetRefresher(url, url2)
+
+def artifact_version():
+    # Sortable UTC timestamp naming a new artifact
+    # One clock reading, so that the seconds and the nanoseconds agree
+    seconds, nanoseconds = divmod(time.time_ns(), 10 ** 9)
+    return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(seconds)) + f"-{nanoseconds:09d}"
+
+def frame_table(df, version=None):
+    # Arrow table of a DataFrame, carrying its version in the schema metadata
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if version is not None:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), ARTIFACT_VERSION_KEY: version.encode()})
+    return table
+
+def frame_to_ipc(df, version=None):
+    # Arrow IPC file bytes of a DataFrame, as stored in the shared cache
+    sink = pa.BufferOutputStream()
+    table = frame_table(df, version)
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def frame_from_ipc(source):
+    # The DataFrame and version read from an Arrow IPC file, a memory map or a buffer
+    table = pa.ipc.open_file(source).read_all()
+    version = (table.schema.metadata or {}).get(ARTIFACT_VERSION_KEY, b'').decode() or None
+    return table.to_pandas(split_blocks=True), version
+
+def write_artifact(df, directory=ARTIFACT_DIR, keep=ARTIFACTS_KEPT):
+    """
+    Publish a preprocessed school DataFrame as a new versioned Arrow IPC artifact.
+
+    The file is written uncompressed so readers can memory-map it, then the CURRENT
+    pointer is swapped atomically to it. Only the ``keep`` newest artifacts (at least
+    the new one) are kept; processes still mapping an older one keep their pages until
+    they reopen.
+
+    Returns the path of the new artifact.
+    """
+    os.makedirs(directory, exist_ok=True)
+    version = artifact_version()
+    table = frame_table(df, version)
+
+    path = os.path.join(directory, f"{ARTIFACT_PREFIX}{version}.arrow")
+    with pa.OSFile(f"{path}.tmp", 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(f"{path}.tmp", path)
+
+    pointer = os.path.join(directory, ARTIFACT_POINTER)
+    with open(f"{pointer}.{os.getpid()}.tmp", 'w') as f:
+        f.write(os.path.basename(path))
+    os.replace(f"{pointer}.{os.getpid()}.tmp", pointer)
+
+    artifacts = sorted(name for name in os.listdir(directory) if name.startswith(ARTIFACT_PREFIX) and name.endswith('.arrow'))
+    for name in artifacts[:-max(keep, 1)]:
+        os.remove(os.path.join(directory, name))
+    return path
+
+def current_artifact(directory=ARTIFACT_DIR):
+    # Path of the published artifact, or None when nothing has been ingested
+    try:
+        with open(os.path.join(directory, ARTIFACT_POINTER)) as f:
+            path = os.path.join(directory, f.read().strip())
+    except FileNotFoundError:
+        return None
+    return path if os.path.exists(path) else None
+
+# Define the open_artifact function with st.cache_resource so every session of the process shares the mapping
+@st.cache_resource(max_entries=2)
+def open_artifact(path):
+    """
+    Open a published artifact memory-mapped and build the PreparedDataset over it.
+
+    Numeric columns without nulls are views over the mapped file, so processes opening
+    the same artifact share those pages; categorical columns only materialize their codes.
+    """
+    count('cache_misses.open_artifact')
+    with span('open_artifact', path=path):
+        df, version = frame_from_ipc(pa.memory_map(path))
+    with span('build_indexes'):
+        return PreparedDataset(df, version)
+
+def debug_enabled():
+    # The debug panel is hidden unless the page is opened with ?debug=1
+    return st.query_params.get('debug') == '1'
+
+def traced_fragment(func):
+    """
+    st.fragment whose fragment-only reruns are traced like full ones.
+
+    Within a full run the fragment records into the run's trace. Rerun on its own, it
+    starts a trace, logs it as a rerun of that fragment and redraws the debug panel
+    that main reserved in the session state.
+    """
+    @functools.wraps(func)
+    def traced(*args, **kwargs):
+        panel = st.session_state.get('debug_panel') if debug_enabled() else None
+        if telemetry.current_trace() is not None or not (debug_enabled() or telemetry.is_enabled()):
+            if panel is not None:
+                # Streamlit only lets a fragment rerun write to an outside container it wrote to before
+                panel[0].empty()
+            return func(*args, **kwargs)
+        trace = start_trace()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if panel is not None:
+                display_debug_panel(trace, *panel[1:], placeholder=panel[0])
+            finish_trace(trace, fragment=func.__name__)
+    return st.fragment(traced)
+
+def quiet_streamlit_logs(level='error'):
+    """
+    Lower Streamlit's loggers to ``level`` for processes calling the cached functions
+    outside `streamlit run`, where Streamlit warns about every call.
+
+    Returns the configured level, to restore it with streamlit.logger.set_log_level.
+    """
+    # Reading the config parses it first, which would reset the level afterwards
+    configured = st.get_option('logger.level')
+    streamlit.logger.set_log_level(level)
+    return configured
 
 def setup_page():
     # Set page configuration
@@ -108,17 +1089,60 @@ def setup_page():
     # Example of a custom button call; ensure this function is defined or imported in your script
     button(username="marqitus", floating=False, width=221)
 
-def get_nearby_schools_df(df, selected_municipality, selected_school):
-    nearby_schools_df = df[df['nom_municipi'] == selected_municipality]
-    nearby_schools_df['address'] = nearby_schools_df['nom_municipi'] + ', ' + nearby_schools_df['nom_comarca']
-    nearby_schools_df = nearby_schools_df.dropna(subset=['coordenades_geo_x', 'coordenades_geo_y'])
-    nearby_schools_df = nearby_schools_df[(nearby_schools_df['denominaci_completa'] != selected_school) & (nearby_schools_df['nom_municipi'] == selected_municipality)]
-    return nearby_schools_df
+def has_coordinates(school_info):
+    # preprocess_school_data fills missing coordinates with (0, 0)
+    return not (pd.isna(school_info['coordenades_geo_x']) or pd.isna(school_info['coordenades_geo_y'])
+                or (school_info['coordenades_geo_x'] == 0 and school_info['coordenades_geo_y'] == 0))
+
+def get_nearby_schools_df(dataset, school_info):
+    """
+    One row per located school of the selected school's municipality, other than itself.
+    The map centres on them when the selected school has no coordinates.
+    """
+    points = dataset.school_points
+    nearby_schools_df = points[points['nom_municipi'] == school_info['nom_municipi']]
+    return nearby_schools_df[nearby_schools_df['codi_centre'] != school_info['codi_centre']]
+
+def get_closest_schools_df(dataset, school_info, n=CLOSEST_SCHOOLS):
+    # The n schools closest to the selected one (excluding itself), with their distance in metres
+    if not has_coordinates(school_info):
+        return dataset.school_points.iloc[[]].assign(distance=[])
+    positions, distances = dataset.spatial_index.nearest(school_info['coordenades_geo_y'], school_info['coordenades_geo_x'], n + 1)
+    closest_df = dataset.school_points.iloc[positions].assign(distance=distances)
+    return closest_df[closest_df['codi_centre'] != school_info['codi_centre']].head(n)
 
-def create_pydeck_layer(df, color):
+def display_closest_schools(dataset, school_info):
+    # Table of the closest schools with their distance in km
+    closest_df = get_closest_schools_df(dataset, school_info)
+    if closest_df.empty:
+        st.write("No hi ha coordenades per a aquesta escola.")
+        return
+    st.dataframe(
+        pd.DataFrame({
+            'Escola': closest_df['denominaci_completa'].astype(str),
+            'Municipi': closest_df['nom_municipi'].astype(str),
+            'Naturalesa': closest_df['nom_naturalesa'].astype(str),
+            'Distància (km)': (closest_df['distance'] / 1000).round(2),
+        }),
+        hide_index=True,
+        width='stretch',
+    )
+
+def school_points_frame(df):
+    # The few columns drawn on the map: position, code (for selections) and name (for the tooltip)
+    return pd.DataFrame({
+        'lon': df['coordenades_geo_x'].astype(float).round(5),
+        'lat': df['coordenades_geo_y'].astype(float).round(5),
+        'codi_centre': df['codi_centre'].astype(str),
+        'name': df['denominaci_completa'].astype(str),
+    })
+
+def create_pydeck_layer(df, color, layer_id):
+    # data is either a DataFrame or the URL of a JSON file with the same records
     layer = pdk.Layer(
         "ScatterplotLayer",
-        data=df[['coordenades_geo_x', 'coordenades_geo_y', 'denominaci_completa', 'codi_centre', 'nom_naturalesa', 'address', 'nom_municipi','adre_a','tel_fon','e_mail_centre','url']].rename(columns={'coordenades_geo_x': 'lon', 'coordenades_geo_y': 'lat'}),
+        id=layer_id,
+        data=school_points_frame(df) if isinstance(df, pd.DataFrame) else df,
         get_position='[lon, lat]',
         get_color=color,
         get_radius=50,
@@ -126,91 +1150,156 @@ def create_pydeck_layer(df, color):
     )
     return layer
 
-def plot_pre_registration_evolution(filtered_df):
-    
-    for ense in filtered_df['nom_ensenyament'].unique():
-        min_nivell_per_ense = filtered_df.groupby('nom_ensenyament')['nivell'].transform(min)
-        min_nivell_df = filtered_df[filtered_df['nivell'] == min_nivell_per_ense]
-        min_nivell_df = min_nivell_df.sort_values(by='curs', ascending=True)
-
-        fig = go.Figure()
-
-        for curs in min_nivell_df['curs'].unique():
-            curs_df = min_nivell_df[min_nivell_df['curs'] == curs]
-
-            fig.add_trace(go.Bar(
-                x=curs_df['curs'],
-                y=curs_df['oferta_inicial_places'],
-                name='Initial Seat Offerings',
-                marker_color='lightgray'
-            ))
-
-            fig.add_trace(go.Bar(
-                x=curs_df['curs'],
-                y=curs_df['assignacions_1a_peticio'],
-                base=0,
-                name='1st Choice Assignments',
-                marker_color='blue',
-                width=0.2
-            ))
-
-            fig.add_trace(go.Bar(
-                x=curs_df['curs'],
-                y=curs_df['assignacions_altres_peticions'],
-                base=curs_df['assignacions_1a_peticio'],
-                name='Other Assignments',
-                marker_color='rgba(135, 206, 250, 0.6)',
-                width=0.2
-            ))
-
-        fig.update_layout(
-            autosize=True,
-            barmode='overlay',
-            xaxis=dict(type='category', title="Curs"),
-            yaxis=dict(title=""),
-            title_text=f"{ense}",
-            dragmode=False,
-            showlegend=False,
-        )
+# Module globals of the app script are reset on every rerun, so the state lives in a process-wide resource
+@st.cache_resource
+def published_school_points():
+    # Points files this process wrote, oldest first (the only ones it may delete), and their lock
+    return [], threading.Lock()
+
+def publish_school_points(df, directory=STATIC_DIR, keep=SCHOOL_POINTS_KEPT):
+    """
+    Write the map points as a static JSON file, unless it exists.
 
-        st.plotly_chart(fig, use_container_width=True, config={"displayModeBar": False})
+    The file is named after a hash of its content, so browsers can cache it for good
+    and every replica publishing the same points shares one file. Each process only
+    prunes the files it wrote itself, keeping the ``keep`` most recent, so that it
+    never deletes a file another process still serves.
 
-def display_school_map(df, selected_municipality, selected_school, school_info):
+    Returns the URL the browser loads it from.
     """
-    Display a map with layers for nearby schools and the selected school.
+    payload = school_points_frame(df).to_json(orient='records').encode()
+    name = f"{SCHOOL_POINTS_PREFIX}{hashlib.sha1(payload).hexdigest()[:16]}.json"
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+        published, lock = published_school_points()
+        with lock:
+            published.append(path)
+            stale = published[:-max(keep, 1)]
+            del published[:-max(keep, 1)]
+        for stale_path in stale:
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+    return f"{STATIC_URL}/{name}"
+
+# The base layer of every school is built once per dataset version and shared by every rerun
+@st.cache_resource(max_entries=2)
+def build_base_map_layer(_dataset, dataset_version):
+    """
+    Gray layer with every located school. With static serving on, the layer only holds
+    the URL of its points and the browser downloads them once per dataset version;
+    otherwise the compact points are embedded in the deck.
+    """
+    count('cache_misses.base_map_layer')
+    data = _dataset.school_points
+    if st.get_option('server.enableStaticServing'):
+        data = publish_school_points(data)
+    return create_pydeck_layer(data, '[169, 169, 169, 160]', 'schools')  # Dark gray color
+
+def assignment_traces(categories, df, orientation='v', offer_width=None, hovertemplates=(None, None, None)):
+    """
+    The three overlaid bars used by every chart: seat offer, 1st choice assignments and
+    other assignments stacked on top of them, one trace each for all the categories.
 
     Args:
-    - df: The full DataFrame containing schools data.
-    - selected_municipality: The municipality selected by the user.
-    - selected_school: The school selected by the user.
-    - school_info: A dict or similar object containing 'coordenades_geo_x' and 'coordenades_geo_y' for the selected school.
-    """
-    # Extract school's latitude and longitude from school_info
-    school_lat = school_info['coordenades_geo_y']
-    school_lon = school_info['coordenades_geo_x']
-    
-    # Generate DataFrame for nearby schools
-    nearby_schools_df = get_nearby_schools_df(df, selected_municipality, selected_school)
-    
-    # Create a layer for nearby schools
-    nearby_schools_layer = create_pydeck_layer(nearby_schools_df, '[169, 169, 169, 160]')  # Dark gray color
-    
-    # Filter DataFrame for the selected school
-    filtered_df = df[df['denominaci_completa'] == selected_school]
-    
-    # Create a layer for the selected school
-    selected_school_layer = create_pydeck_layer(filtered_df, '[255, 0, 0, 160]')  # Red color
-    
-    # Define the tooltip for interactivity
+    - categories: Values for the category axis, one per row of df.
+    - df: DataFrame with 'oferta_inicial_places', 'assignacions_1a_peticio' and 'assignacions_altres_peticions'.
+    - orientation: 'v' for vertical bars, 'h' for horizontal ones.
+    - offer_width: Width of the seat offer bars, or None for plotly's default.
+    - hovertemplates: Hover templates of the three traces.
+    """
+    first_choice = df['assignacions_1a_peticio'].to_numpy(dtype=float, na_value=np.nan)
+    values = [df['oferta_inicial_places'].to_numpy(dtype=float, na_value=np.nan),
+              first_choice,
+              df['assignacions_altres_peticions'].to_numpy(dtype=float, na_value=np.nan)]
+    category_axis, value_axis = ('x', 'y') if orientation == 'v' else ('y', 'x')
+
+    def trace(value, **kwargs):
+        return go.Bar(**{category_axis: categories, value_axis: value}, orientation=orientation, **kwargs)
+
+    return [
+        trace(values[0], name='Initial Seat Offerings', marker_color='lightgray',
+              width=offer_width, hovertemplate=hovertemplates[0]),
+        trace(values[1], base=0, name='1st Choice Assignments', marker_color='blue',
+              width=0.2, hovertemplate=hovertemplates[1]),
+        trace(values[2], base=first_choice, name='Other Assignments', marker_color='rgba(135, 206, 250, 0.6)',
+              width=0.2, hovertemplate=hovertemplates[2]),
+    ]
+
+# Figures are built once per (dataset version, school, ensenyament, curs) and shared by every rerun
+@st.cache_resource(max_entries=FIGURE_CACHE_SIZE)
+def build_evolution_figure(_school_df, dataset_version, school, ense):
+    # Seats and assignments of the entry level (lowest nivell) of an ensenyament across the years
+    count('cache_misses.figure')
+    ense_df = _school_df[_school_df['nom_ensenyament'] == ense]
+    entry_df = ense_df[ense_df['nivell'] == ense_df['nivell'].min()].sort_values(by='curs', ascending=True)
+
+    fig = go.Figure(assignment_traces(entry_df['curs'].astype(str).to_numpy(), entry_df))
+
+    fig.update_layout(
+        autosize=True,
+        barmode='overlay',
+        xaxis=dict(type='category', title="Curs"),
+        yaxis=dict(title=""),
+        title_text=f"{ense}",
+        dragmode=False,
+        showlegend=False,
+    )
+    return fig
+
+def plot_pre_registration_evolution(filtered_df, dataset_version, school):
+    """
+    Plot the evolution of the entry level of each ensenyament of a school.
+
+    Args:
+    - filtered_df: DataFrame containing the rows of the selected school.
+    - dataset_version: Version of the dataset the rows come from, for the figure cache.
+    - school: The 'codi_centre' of the selected school.
+    """
+    for ense in filtered_df['nom_ensenyament'].unique():
+        count('cache_calls.figure')
+        with span('figure', chart='evolution', ensenyament=ense):
+            fig = build_evolution_figure(filtered_df, dataset_version, school, ense)
+            st.plotly_chart(fig, width='stretch', config={"displayModeBar": False})
+
+def display_school_map(dataset, school_info):
+    """
+    Display a map of every school with the selected school highlighted, centred on it.
+    Clicking a school shows its details below the map.
+
+    Args:
+    - dataset: The PreparedDataset containing schools data.
+    - school_info: A row of the selected school, with its coordinates, 'nom_municipi' and 'codi_centre'.
+    """
+    # Extract school's latitude and longitude from school_info, or centre on its municipality when unknown
+    if has_coordinates(school_info):
+        school_lat = float(school_info['coordenades_geo_y'])
+        school_lon = float(school_info['coordenades_geo_x'])
+    else:
+        nearby_schools_df = get_nearby_schools_df(dataset, school_info)
+        school_lat = float(nearby_schools_df['coordenades_geo_y'].mean()) if not nearby_schools_df.empty else 41.59
+        school_lon = float(nearby_schools_df['coordenades_geo_x'].mean()) if not nearby_schools_df.empty else 1.52
+
+    with span('map_layers'):
+        count('cache_calls.base_map_layer')
+        schools_layer = build_base_map_layer(dataset, dataset.version)
+
+        # Look up the selected school among the located schools
+        filtered_df = dataset.school_points[dataset.school_points['codi_centre'] == school_info['codi_centre']]
+
+        # Create a layer for the selected school
+        selected_school_layer = create_pydeck_layer(filtered_df, '[255, 0, 0, 160]', 'selected')  # Red color
+
+    # Only the name travels with the points; the details are shown when a school is clicked
     tooltip = {
-        "html": "<b>Nom:</b> {denominaci_completa}<br/>" +
-                "<b>Codi</b> {codi_centre}<br/>" +
-                "<b>Naturalesa:</b> {nom_naturalesa}<br/>" +
-                "<b>Adreça:</b> {adre_a}<br/>" +
-                "<b>Municipi:</b> {address}<br/>" +
-                "<b>Telèfon:</b> {tel_fon}<br/>"+
-                "<b>Correu electrònic:</b> {e_mail_centre}<br/>"+
-                "<b>Web:</b> {url}", 
+        "html": "<b>{name}</b>",
         "style": {
             "backgroundColor": "steelblue",
             "color": "white"
@@ -218,7 +1307,7 @@ def display_school_map(df, selected_municipality, selected_school, school_info):
     }
 
     # Display the map
-    st.pydeck_chart(pdk.Deck(
+    event = st.pydeck_chart(pdk.Deck(
         map_style='mapbox://styles/mapbox/light-v9',
         initial_view_state=pdk.ViewState(
             latitude=school_lat,
@@ -226,76 +1315,96 @@ def display_school_map(df, selected_municipality, selected_school, school_info):
             zoom=15,
             pitch=0,
         ),
-        layers=[nearby_schools_layer, selected_school_layer],
+        layers=[schools_layer, selected_school_layer],
         tooltip=tooltip
+    ), on_select='rerun', selection_mode='single-object')
+
+    picked = [obj for objects in event.selection.objects.values() for obj in objects]
+    if picked:
+        display_school_details(dataset, picked[0]['codi_centre'])
+
+def display_school_details(dataset, code):
+    # Contact details of a school clicked on the map
+    school_df = dataset.school(code)
+    if school_df.empty:
+        return
+    info = school_df.iloc[0]
+    st.markdown(
+        f"**{info['denominaci_completa']}** ({info['codi_centre']})  \n"
+        f"**Naturalesa:** {info['nom_naturalesa']}  \n"
+        f"**Adreça:** {info['adre_a']}, {info['address']}  \n"
+        f"**Telèfon:** {info['tel_fon']}  \n"
+        f"**Correu electrònic:** {info['e_mail_centre']}  \n"
+        f"**Web:** {info['url']}"
+    )
+
+@st.cache_resource(max_entries=FIGURE_CACHE_SIZE)
+def build_inscriptions_figure(_school_df, dataset_version, school, ense, curs):
+    # Seats and assignments of every nivell of an ensenyament in one curs
+    count('cache_misses.figure')
+    ense_df = _school_df[(_school_df['nom_ensenyament'] == ense) & (_school_df['curs'] == curs)]
+    ense_df = ense_df.sort_values(by='nivell', ascending=True)
+
+    fig = go.Figure(assignment_traces(
+        ense_df['nivell'].astype(str).to_numpy(),
+        ense_df,
+        offer_width=0.4,
+        hovertemplates=(
+            '<b>Nivell:</b> %{x}<br><b>Oferta de places:</b> %{y}<extra></extra>',
+            '<b>Nivell:</b> %{x}<br><b>1a opció:</b> %{y}<extra></extra>',
+            '<b>Nivell:</b> %{x}<br><b>Altres peticions:</b> %{y}<extra></extra>',
+        ),
     ))
-    
-def plot_inscriptions_by_curs(filtered_df):
+
+    # Update the layout for the figure
+    fig.update_layout(
+        autosize=True,
+        barmode='overlay',  # Allows the gray range bars to act as background
+        xaxis=dict(type='category', title="Nivell"),
+        yaxis=dict(title="Places"),
+        title_text=f"Inscripcions per {ense} en {curs}",
+        showlegend=False,
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
+    )
+    return fig
+
+@traced_fragment
+def plot_inscriptions_by_curs(filtered_df, dataset_version, school):
     """
-    Plot inscriptions for courses or levels within a selected school year.
+    Plot inscriptions for courses or levels within a selected school year. Runs as a
+    fragment, so changing the curs only rebuilds these charts.
     
     Args:
     - filtered_df: DataFrame containing the filtered school data.
+    - dataset_version: Version of the dataset the rows come from, for the figure cache.
+    - school: The 'codi_centre' of the selected school.
     """
     # Selector for unique "Curs" values
     unique_curs = filtered_df['curs'].unique()
     selected_curs = st.selectbox('Selecciona un curs escolar:', options=unique_curs)
     
     for ense in filtered_df['nom_ensenyament'].unique():
-        ense_df = filtered_df[(filtered_df['nom_ensenyament'] == ense) & (filtered_df['curs'] == selected_curs)]
-        ense_df = ense_df.sort_values(by='nivell', ascending=True)
-
-        fig = go.Figure()
-
-        # Iterate through each "nivell" and plot its data
-        for nivell in ense_df['nivell'].unique():
-            nivell_df = ense_df[ense_df['nivell'] == nivell]
-            
-            # Initial Seat Offerings
-            fig.add_trace(go.Bar(
-                x=[nivell],
-                y=nivell_df['oferta_inicial_places'],
-                name='Initial Seat Offerings',
-                marker_color='lightgray',
-                width=0.4,
-                hovertemplate='<b>Nivell:</b> %{x}<br><b>Oferta de places:</b> %{y}<extra></extra>'
-            ))
-
-            # 1st Choice Assignments
-            fig.add_trace(go.Bar(
-                x=[nivell],
-                y=nivell_df['assignacions_1a_peticio'],
-                base=0,
-                name='1st Choice Assignments',
-                marker_color='blue',
-                width=0.2,
-                hovertemplate='<b>Nivell:</b> %{x}<br><b>1a opció:</b> %{y}<extra></extra>'
-            ))
-
-            # Other Assignments
-            fig.add_trace(go.Bar(
-                x=[nivell],
-                y=nivell_df['assignacions_altres_peticions'],
-                base=nivell_df['assignacions_1a_peticio'],
-                name='Other Assignments',
-                marker_color='rgba(135, 206, 250, 0.6)',
-                width=0.2,
-                hovertemplate='<b>Nivell:</b> %{x}<br><b>Altres peticions:</b> %{y}<extra></extra>'
-            ))
-
-        # Update the layout for the figure
-        fig.update_layout(
-            autosize=True,
-            barmode='overlay',  # Allows the gray range bars to act as background
-            xaxis=dict(type='category', title="Nivell"),
-            yaxis=dict(title="Places"),
-            title_text=f"Inscripcions per {ense} en {selected_curs}",
-            showlegend=False,
-            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
-        )
+        count('cache_calls.figure')
+        with span('figure', chart='inscriptions', ensenyament=ense, curs=selected_curs):
+            fig = build_inscriptions_figure(filtered_df, dataset_version, school, ense, selected_curs)
 
-        # Display the figure with disabled Plotly menu and static plot configuration
-        st.plotly_chart(fig, use_container_width=True, config={"displayModeBar": False})
+            # Display the figure with disabled Plotly menu and static plot configuration
+            st.plotly_chart(fig, width='stretch', config={"displayModeBar": False})
+
+def build_comparison_figure(filtered_df):
+    # Horizontal bars with the schools on the y-axis
+    fig = go.Figure(assignment_traces(filtered_df['school_with_municipality'].astype(str).to_numpy(), filtered_df, orientation='h'))
+
+    # Update layout for clarity, adjusting axis titles for the horizontal orientation
+    fig.update_layout(
+        title='',
+        yaxis_title="",
+        xaxis_title="",
+        legend_title="Metric",
+        barmode='overlay',  # Overlaid bars to approximate a bullet chart
+        showlegend=False,  # Hide legend if not needed
+    )
+    return fig
 
 def plot_data_across_schools(filtered_df):
     """
@@ -306,168 +1415,309 @@ def plot_data_across_schools(filtered_df):
     """
     # Check if the DataFrame is not empty
     if not filtered_df.empty:
-      
-        fig = go.Figure()
-
-        # Main measure - "oferta_inicial_places", now plotted on the x-axis for a horizontal bar
-        fig.add_trace(go.Bar(
-            y=filtered_df['school_with_municipality'],  # This now sets the categories on the y-axis
-            x=filtered_df['oferta_inicial_places'],  # Values on the x-axis
-            orientation='h',  # Specify the bar orientation as horizontal
-            name='Initial Seat Offerings',
-            marker_color='lightgray',
-        ))
-
-        # Comparative measure 1 - "assignacions_1a_peticio"
-        fig.add_trace(go.Bar(
-            y=filtered_df['school_with_municipality'],
-            x=filtered_df['assignacions_1a_peticio'],
-            name='1st Choice Assignments',
-            base=0,
-            marker_color='blue',
-            orientation='h',  # Horizontal orientation
-            width=0.2,  # Adjust width to control the bar thickness
-        ))
-
-        # Comparative measure 2 - "assignacions_altres_peticions"
-        fig.add_trace(go.Bar(
-            y=filtered_df['school_with_municipality'],
-            x=filtered_df['assignacions_altres_peticions'],
-            orientation='h',  # Horizontal orientation
-            base=filtered_df['assignacions_1a_peticio'],
-            marker_color='rgba(135, 206, 250, 0.6)',
-            name='Other Assignments',
-            width=0.2,  # Adjust width to control the bar thickness
-        ))
-
-        # Update layout for clarity, adjusting axis titles for the horizontal orientation
-        fig.update_layout(
-            title='',
-            yaxis_title="",
-            xaxis_title="",
-            legend_title="Metric",
-            barmode='overlay',  # Overlaid bars to approximate a bullet chart
-            showlegend=False,  # Hide legend if not needed
-        )
-
         # Display the figure in the Streamlit app
-        st.plotly_chart(fig, use_container_width=True, config={"displayModeBar": False})
-
-        
+        with span('figure', chart='comparison'):
+            st.plotly_chart(build_comparison_figure(filtered_df), width='stretch', config={"displayModeBar": False})
     else:
         st.write("No data available to plot.")
 
+def restore_widget(key):
+    # Streamlit drops the state of the widgets a run doesn't draw, like those of a closed tab,
+    # so put back the value kept_widget saved the last time the widget was drawn
+    kept = f'kept_{key}'
+    if key not in st.session_state and kept in st.session_state:
+        st.session_state[key] = st.session_state[kept]
+
+def kept_widget(widget, *args, key, **kwargs):
+    """
+    Draw ``widget`` with the value it had when it was last drawn, even if a run (of a
+    closed tab) skipped it in between, and return its value.
+    """
+    restore_widget(key)
+    value = widget(*args, key=key, **kwargs)
+    st.session_state[f'kept_{key}'] = value
+    return value
+
+
+@traced_fragment
+def display_school_tab(dataset):
+    """
+    The "Busca una escola" tab. Runs as a fragment, so choosing another school only
+    reruns this tab.
+
+    Args:
+    - dataset: The PreparedDataset containing schools data.
+    """
+    # Search the schools as the user types and offer only the best matches, keyed by their code
+    query = kept_widget(st.text_input, 'Busca una escola (nom, municipi o codi):', key='school_query')
+    with span('search_schools'):
+        matches = dataset.search(query)
+    if not matches:
+        st.write("Cap escola coincideix amb la cerca.")
+        return
+    selected_school = kept_widget(st.selectbox, 'Filtra una escola:', options=matches, format_func=dataset.school_label, key='school_code')
+
+    # Look up the rows of the selected school
+    with span('select_school'):
+        filtered_df = dataset.school(selected_school)
+
+    if not filtered_df.empty:
+        school_info = filtered_df.iloc[0]  # Assuming each school name is unique
+
+        #################
+        st.subheader("Situació de les escoles properes:")
+        st.markdown("""Mapa amb <span style="color:red">**l'escola seleccionada**&nbsp;</span> i les **escoles del voltant**. Cliqueu una escola per veure'n les dades de contacte.""", unsafe_allow_html=True)
+
+        display_school_map(dataset, school_info)
+
+        #################
+        st.subheader("Escoles més properes:")
+        display_closest_schools(dataset, school_info)
+
+        #################
+        st.subheader("Evolució en les preinscripcions:")
+        st.markdown("""En aquesta visualització es poden veure les inscripcions de l'escola en el curs s'entrada en els diferents anys. (
+        <span style="color:lightgray">**Oferta de places**&nbsp;</span>
+        <span style="color:blue">**1a opció**&nbsp;</span>
+        <span style="color:rgba(135, 206, 250, 0.6)">**Assignació posterior**</span>
+        )""", unsafe_allow_html=True)
+        plot_pre_registration_evolution(filtered_df, dataset.version, selected_school)
+
+        #################
+        st.subheader("Inscripcions pels cursos o nivells:")
+        st.markdown("""En aquesta visualització es poden veure les inscripcions de l'escola en tots els cursos, no només en els primers cursos de cada etapa educativa.""", unsafe_allow_html=True)
+        plot_inscriptions_by_curs(filtered_df, dataset.version, selected_school)
+
+@traced_fragment
+def display_comparison_tab(dataset):
+    """
+    The "Compara escoles" tab. Runs as a fragment, so changing the selected schools
+    only reruns this tab.
+
+    Args:
+    - dataset: The PreparedDataset containing schools data.
+    """
+    # The selected schools stay available whatever the search, next to the matches of the query
+    restore_widget('compare_codes')
+    selected_codes = st.session_state.setdefault('compare_codes', dataset.school_options[:1])
+    query = kept_widget(st.text_input, 'Busca escoles per afegir:', key='compare_query')
+    with span('search_schools'):
+        matches = dataset.search(query)
+    options = list(dict.fromkeys([*selected_codes, *matches]))
+    selected_codes = kept_widget(st.multiselect, 'Selecciona escoles:', options=options, format_func=dataset.school_label, key='compare_codes')
+
+    # Rows of the selected schools
+    filtered_multi_df = dataset.schools(selected_codes)
+
+    display_comparison_chart(filtered_multi_df)
+
+@traced_fragment
+def display_comparison_chart(filtered_multi_df):
+    """
+    The ensenyament, curs and nivell selectors and the comparison chart. Runs as a
+    fragment of its own, so changing a selector only rebuilds this chart.
+
+    Args:
+    - filtered_multi_df: DataFrame containing the rows of the selected schools.
+    """
+    # Selector for educational program types (nom_ensenyament)
+    unique_ense = filtered_multi_df['nom_ensenyament'].unique()
+    selected_ense = kept_widget(st.selectbox, 'Selecciona un tipus d’ensenyament:', options=unique_ense, key='unique_ense_key')
+    # Selector for "curs" (year/course)
+    unique_curs = filtered_multi_df['curs'].unique()
+
+    # Selector for "nivell" (level); rows without one can't be compared by level
+    unique_nivell = sorted(filtered_multi_df['nivell'].dropna().unique())
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        selected_curs = kept_widget(st.selectbox, 'Selecciona un curs escolar:', options=unique_curs, key='unique_curs_key')
+
+    with col2:
+        selected_nivell = kept_widget(st.selectbox, 'Selecciona un nivell:', options=unique_nivell, key='unique_nivell_key')
+
+    with span('filter_comparison'):
+        # Further filtering based on selected educational program
+        filtered_multi_df = filtered_multi_df[filtered_multi_df['nom_ensenyament'] == selected_ense]
+        # Further filtering based on selected "curs"
+        filtered_multi_df = filtered_multi_df[filtered_multi_df['curs'] == selected_curs]
+        # Final filtering based on selected "nivell"
+        filtered_multi_df = filtered_multi_df[filtered_multi_df['nivell'] == selected_nivell]
+
+    if not filtered_multi_df.empty:
+
+        st.subheader('Comparativa de places entre escoles:')
+
+        st.markdown("""Inscripcions de les escoles seleccionades en el curs i nivell seleccionats. (
+        <span style="color:lightgray">**Oferta de places**&nbsp;</span>
+        <span style="color:blue">**1a opció**&nbsp;</span>
+        <span style="color:rgba(135, 206, 250, 0.6)">**Assignació posterior**</span>
+        )""", unsafe_allow_html=True)
+
+        plot_data_across_schools(filtered_multi_df)
+
+    else:
+        st.write("No data available for the selected schools/municipalities.")
+
+def ranking_table(ranked_df):
+    # Ranked cube rows as displayed: school, municipality and the demand metrics
+    return pd.DataFrame({
+        'Escola': ranked_df['denominaci_completa'].astype(str),
+        'Municipi': ranked_df['nom_municipi'].astype(str),
+        'Places': ranked_df['oferta_inicial_places'],
+        '1a opció / places': ranked_df['oversubscription'],
+        'Ocupació': ranked_df['fill_rate'],
+        'Variació anual': ranked_df['oversubscription_change'],
+    })
+
+def ranking_ends(ranked, size=RANKING_SIZE):
+    # The ``size`` most demanded schools and, least demanded first, up to ``size`` of the others
+    return ranked.head(size), ranked.iloc[max(size, len(ranked) - size):].iloc[::-1]
+
+def display_ranking(title, ranked_df):
+    st.subheader(title)
+    st.dataframe(
+        ranking_table(ranked_df),
+        hide_index=True,
+        width='stretch',
+        column_config={
+            '1a opció / places': st.column_config.NumberColumn(format='percent'),
+            'Ocupació': st.column_config.NumberColumn(format='percent'),
+            'Variació anual': st.column_config.NumberColumn(format='percent'),
+        },
+    )
+
+@traced_fragment
+def display_ranking_tab(dataset):
+    """
+    The "Rànquing" tab: the most and least oversubscribed schools of a municipality or
+    comarca, by 1st choice assignments per seat at the entry level of an ensenyament.
+    Reads the precomputed demand cube, so nothing is aggregated here.
+
+    Args:
+    - dataset: The PreparedDataset containing schools data.
+    """
+    scope = kept_widget(st.radio, 'Àmbit:', options=list(RANKING_SCOPES), horizontal=True, key='ranking_scope')
+    column = RANKING_SCOPES[scope]
+    area = kept_widget(st.selectbox, f'{scope}:', options=dataset.areas(column), key=f'ranking_{column}')
+
+    with span('ranking', scope=column):
+        area_cube = dataset.area_cube(column, area)
+        entry_cube = area_cube[area_cube['entry_level']]
+
+        selected_ense = kept_widget(st.selectbox, 'Selecciona un tipus d’ensenyament:', options=entry_cube['nom_ensenyament'].unique(), key='ranking_ense')
+        ense_cube = entry_cube[entry_cube['nom_ensenyament'] == selected_ense]
+        selected_curs = kept_widget(st.selectbox, 'Selecciona un curs escolar:', options=sorted(ense_cube['curs'].unique(), reverse=True), key='ranking_curs')
+
+        ranked = ense_cube[ense_cube['curs'] == selected_curs].dropna(subset=['oversubscription'])
+        ranked = ranked.sort_values('oversubscription', ascending=False, kind='stable')
+
+    if ranked.empty:
+        st.write("No hi ha dades per a aquesta selecció.")
+        return
+
+    st.markdown("""Escoles ordenades per les **assignacions en 1a opció per plaça oferta** al primer nivell de l'ensenyament.
+    Per sobre del 100% hi ha hagut més famílies que l'han triada en primer lloc que places.""")
+    most, least = ranking_ends(ranked)
+    display_ranking("Més demanades:", most)
+    if not least.empty:
+        display_ranking("Menys demanades:", least)
+
+def display_debug_panel(trace, dataset, refresher=None, placeholder=None):
+    """
+    Show the timings and counters of this rerun in the sidebar.
+
+    Args:
+    - trace: The telemetry Trace recorded during the rerun.
+    - dataset: The PreparedDataset, for its version and memory use, or None when there is none.
+    - refresher: The DatasetRefresher serving the dataset, if any, for its last refresh.
+    - placeholder: The sidebar st.empty the panel replaces, so that a fragment rerun
+      redraws the panel of the full run instead of adding another one.
+    """
+    counters = trace.counters
+    with placeholder.container() if placeholder is not None else st.sidebar:
+        st.subheader("Depuració")
+        st.metric("Temps de l'execució (ms)", f"{trace.elapsed() * 1000:.1f}")
+        st.dataframe(
+            pd.DataFrame(
+                [(name, n, total * 1000) for name, (n, total) in trace.totals().items()],
+                columns=['span', 'n', 'total_ms'],
+            ),
+            hide_index=True,
+            width='stretch',
+        )
+        caches = sorted({name.split('.', 1)[1] for name in counters if name.startswith('cache_calls.')})
+        st.dataframe(
+            pd.DataFrame(
+                [(name, counters[f'cache_calls.{name}'] - counters[f'cache_misses.{name}'], counters[f'cache_misses.{name}']) for name in caches],
+                columns=['cache', 'hits', 'misses'],
+            ),
+            hide_index=True,
+            width='stretch',
+        )
+        if dataset is not None:
+            st.write(f"Versió de les dades: {dataset.version}, {dataset.df.memory_usage(deep=True).sum() / 2 ** 20:.1f} MiB")
+        if refresher is not None:
+            last_refresh = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(refresher.last_refresh)) if refresher.last_refresh else '-'
+            st.write(f"Darrera actualització: {last_refresh}")
+            summary = refresher.last_refresh_summary
+            if summary is not None:
+                st.write(f"Pàgines descarregades: {summary['pages']} en {summary['duration_s']:.1f} s")
+            if refresher.last_error is not None:
+                st.write(f"Error: {refresher.last_error!r}")
 
 def main():
    
     
     setup_page()
+
+    # Only record spans when someone can see them
+    trace = start_trace() if debug_enabled() or telemetry.is_enabled() else None
+    # Reserved before the tabs, so that fragment reruns can redraw the panel in place
+    panel = st.sidebar.empty() if debug_enabled() else None
      
-    url = "https://analisi.transparenciacatalunya.cat/resource/99md-r3rq.csv"
-    url2 = "https://analisi.transparenciacatalunya.cat/resource/kvmv-ahh4.csv"
+    url = PREINSCRIPCIO_URL
+    url2 = ESCOLES_URL
    
-    df = fetch_data(url)
-    escoles_raw = fetch_data(url2)
- 
-    df=preprocess_school_data(df, escoles_raw)
-    
-    
-    if not df.empty:
-        tab1, tab2 = st.tabs(["Busca una escola", "Compara escoles"])
+    # Use the artifact published by ingest.py when there is one, otherwise the dataset refreshed in the background
+    artifact = current_artifact()
+    refresher = None
+    if artifact is not None:
+        count('cache_calls.open_artifact')
+        dataset = open_artifact(artifact)
+    else:
+        refresher = dataset_refresher(url, url2)
+        dataset = refresher.dataset
+        if dataset is not None and refresher.last_error is not None:
+            st.caption("⚠️ No s'han pogut actualitzar les dades. Es mostren les darreres disponibles.")
 
-        with tab1:
-     
-            # Use the new combined column for the school search selector
-            school_options = df['school_with_municipality'].unique()
-            selected_school_with_municipality = st.selectbox('Filtra una escola:', options=school_options)
+    if panel is not None:
+        st.session_state['debug_panel'] = (panel, dataset, refresher)
 
-            # Split the selection to get the school name and municipality
-            selected_school, selected_municipality = selected_school_with_municipality.rsplit(' (', 1)
-            selected_municipality = selected_municipality.rstrip(')')  # Remove the closing parenthesis
+    if dataset is not None and not dataset.df.empty:
+        # Tabs track which one is open so that only the visible one is computed
+        tab1, tab2, tab3 = st.tabs(["Busca una escola", "Compara escoles", "Rànquing"], key='active_tab', on_change='rerun')
 
-            # Filter the dataframe based on the selected school name and municipality
-            filtered_df = df[(df['denominaci_completa'] == selected_school) & (df['nom_municipi'] == selected_municipality)]
-     
-            if not filtered_df.empty:
-                school_info = filtered_df.iloc[0]  # Assuming each school name is unique
-
-                #################
-                st.subheader("Situació de les escoles del municipi:")
-                st.markdown("""Mapa amb <span style="color:red">**l'escola seleccionada**&nbsp;</span> i les **escoles del municipi.**""", unsafe_allow_html=True)
-         
-                display_school_map(df, selected_municipality, selected_school, school_info)
-
-                #################
-                st.subheader("Evolució en les preinscripcions:")
-                st.markdown("""En aquesta visualització es poden veure les inscripcions de l'escola en el curs s'entrada en els diferents anys. (
-                <span style="color:lightgray">**Oferta de places**&nbsp;</span>
-                <span style="color:blue">**1a opció**&nbsp;</span>
-                <span style="color:rgba(135, 206, 250, 0.6)">**Assignació posterior**</span>
-                )""", unsafe_allow_html=True)
-                plot_pre_registration_evolution(filtered_df)
-                
-                #################
-                st.subheader("Inscripcions pels cursos o nivells:")
-                st.markdown("""En aquesta visualització es poden veure les inscripcions de l'escola en tots els cursos, no només en els primers cursos de cada etapa educativa.""", unsafe_allow_html=True)
-                plot_inscriptions_by_curs(filtered_df)
-                 
+        with tab1:
+            if tab1.open:
+                display_school_tab(dataset)
 
         with tab2:
+            if tab2.open:
+                display_comparison_tab(dataset)
 
-            # Assuming 'school_with_municipality' is a combined column you've created
-            all_options = df['school_with_municipality'].unique()
-            selected_options = st.multiselect('Selecciona escoles:', options=all_options, default=all_options[:1])
-
-            # Further processing based on selected_options
-            # Splitting the selections into schools and municipalities, then filtering the DataFrame accordingly
-            selected_schools, selected_municipalities = zip(*[option.rsplit(' (', 1) for option in selected_options])
-            selected_municipalities = [muni.rstrip(')') for muni in selected_municipalities]
-
-            # Initial filtering based on the selected schools and municipalities
-            filtered_multi_df = df[df['school_with_municipality'].isin(selected_options)]
-            
-            # Selector for educational program types (nom_ensenyament)
-            unique_ense = filtered_multi_df['nom_ensenyament'].unique()
-            selected_ense = st.selectbox('Selecciona un tipus d’ensenyament:', options=unique_ense, key='unique_ense_key')
-            # Selector for "curs" (year/course)
-            unique_curs = filtered_multi_df['curs'].unique()
-
-            # Selector for "nivell" (level)
-            unique_nivell = sorted(filtered_multi_df['nivell'].unique())
-            
-            col1, col2 = st.columns(2)
-
-            with col1:
-                selected_curs = st.selectbox('Selecciona un curs escolar:', options=unique_curs, index=0, key='unique_curs_key')
-
-            with col2:
-                selected_nivell = st.selectbox('Selecciona un nivell:', options=unique_nivell, index=0, key='unique_nivell_key')
-                  
-            # Further filtering based on selected educational program
-            filtered_multi_df = filtered_multi_df[filtered_multi_df['nom_ensenyament'] == selected_ense]
-            # Further filtering based on selected "curs"
-            filtered_multi_df = filtered_multi_df[filtered_multi_df['curs'] == selected_curs]
-            # Final filtering based on selected "nivell"
-            filtered_multi_df = filtered_multi_df[filtered_multi_df['nivell'] == selected_nivell]
-
-
-            if not filtered_multi_df.empty:
-                
-                st.subheader('Comparativa de places entre escoles:')
-                
-                st.markdown("""Inscripcions de les escoles seleccionades en el curs i nivell seleccionats. (
-                <span style="color:lightgray">**Oferta de places**&nbsp;</span>
-                <span style="color:blue">**1a opció**&nbsp;</span>
-                <span style="color:rgba(135, 206, 250, 0.6)">**Assignació posterior**</span>
-                )""", unsafe_allow_html=True)
-                
-                plot_data_across_schools(filtered_multi_df)
-
-            else:
-                st.write("No data available for the selected schools/municipalities.")
+        with tab3:
+            if tab3.open:
+                display_ranking_tab(dataset)
     else:
         st.error("Failed to fetch data.")
 
+    if trace is not None:
+        if panel is not None:
+            display_debug_panel(trace, dataset, refresher, panel)
+        finish_trace(trace)
+
 if __name__ == "__main__":
     main()
     
@@ -0,0 +1,129 @@
+"""
+Lightweight timing spans and counters for the stages of a rerun.
+
+Spans and counters are recorded into the Trace of the current rerun (held in a
+context variable, so every Streamlit session thread has its own) and, when the
+ESCOLES_TRACE_LOG environment variable is set, emitted as one JSON log line each.
+With neither a trace nor logging active, ``span`` returns a shared no-op context
+manager and ``count`` returns immediately.
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+LOG_SPANS = os.environ.get('ESCOLES_TRACE_LOG', '') not in ('', '0')
+
+logger = logging.getLogger('escoles.trace')
+if LOG_SPANS and not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_current_trace = contextvars.ContextVar('escoles_trace', default=None)
+
+def log_event(event, **fields):
+    if LOG_SPANS:
+        logger.info(json.dumps({'event': event, 'ts': time.time(), **fields}, default=str))
+
+class Trace:
+    """
+    The spans and counters recorded during one rerun.
+
+    Safe to update from worker threads that run in a copy of the rerun's context.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name, duration, attrs):
+        with self._lock:
+            self.spans.append((name, duration, attrs))
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def totals(self):
+        # name -> (number of spans, total seconds), in order of first appearance
+        totals = defaultdict(lambda: [0, 0.0])
+        with self._lock:
+            for name, duration, _ in self.spans:
+                totals[name][0] += 1
+                totals[name][1] += duration
+        return {name: tuple(total) for name, total in totals.items()}
+
+class _Span:
+    __slots__ = ('name', 'attrs', 'trace', 'start')
+
+    def __init__(self, name, attrs, trace):
+        self.name = name
+        self.attrs = attrs
+        self.trace = trace
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        if self.trace is not None:
+            self.trace.add_span(self.name, duration, self.attrs)
+        log_event('span', name=self.name, duration_ms=round(duration * 1000, 3),
+                  error=exc_type.__name__ if exc_type else None, **self.attrs)
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(name, **attrs):
+    # Time the enclosed block as a span of the current rerun
+    trace = _current_trace.get()
+    if trace is None and not LOG_SPANS:
+        return _NO_SPAN
+    return _Span(name, attrs, trace)
+
+def count(name, n=1):
+    # Add n to a counter of the current rerun
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.count(name, n)
+
+def current_trace():
+    # The trace being recorded in the current context, or None
+    return _current_trace.get()
+
+def start_trace():
+    # Begin recording a new rerun in the current context
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+def finish_trace(trace, event='rerun', **fields):
+    # Stop recording and log the totals of the rerun (or other traced event), with any extra fields
+    _current_trace.set(None)
+    log_event(event, duration_ms=round(trace.elapsed() * 1000, 3), counters=dict(trace.counters),
+              spans={name: {'count': n, 'total_ms': round(total * 1000, 3)} for name, (n, total) in trace.totals().items()},
+              **fields)
+
+def is_enabled():
+    return LOG_SPANS
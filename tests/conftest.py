@@ -0,0 +1,11 @@
+import pytest
+import streamlit.logger
+
+import escoles2
+
+@pytest.fixture(autouse=True)
+def quiet_streamlit_logs():
+    # Streamlit warns about every cached call made outside `streamlit run`
+    configured = escoles2.quiet_streamlit_logs()
+    yield
+    streamlit.logger.set_log_level(configured)
@@ -0,0 +1,30 @@
+"""
+Versioned Arrow IPC artifacts: pruning of old versions and the ingest command line.
+"""
+import os
+
+import pandas as pd
+import pytest
+
+import escoles2
+import ingest
+
+def artifacts(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.arrow'))
+
+@pytest.mark.parametrize('keep, kept', [(1, 1), (2, 2), (5, 4)])
+def test_only_the_newest_artifacts_are_kept(tmp_path, keep, kept):
+    for i in range(4):
+        path = escoles2.write_artifact(pd.DataFrame({'value': [i]}), str(tmp_path), keep)
+    assert len(artifacts(tmp_path)) == kept
+    assert escoles2.current_artifact(str(tmp_path)) == path
+
+def test_keep_zero_still_keeps_the_current_artifact(tmp_path):
+    for i in range(3):
+        path = escoles2.write_artifact(pd.DataFrame({'value': [i]}), str(tmp_path), keep=0)
+    assert artifacts(tmp_path) == [os.path.basename(path)]
+
+def test_ingest_rejects_keep_below_one(capsys):
+    with pytest.raises(SystemExit):
+        ingest.main(['--keep', '0'])
+    assert '--keep' in capsys.readouterr().err
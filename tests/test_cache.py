@@ -0,0 +1,70 @@
+"""
+The shared cache backends: single-flight computation, expiry and eviction. Redis is
+exercised against the in-process stand-in of benchmarks.fake_redis.
+"""
+import threading
+import time
+
+import pytest
+
+import cache
+from benchmarks.fake_redis import FakeRedis
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def make_cache(request, tmp_path):
+    def make(max_bytes=cache.DEFAULT_MAX_BYTES):
+        if request.param == 'memory':
+            return cache.MemoryCache(max_bytes)
+        if request.param == 'sqlite':
+            return cache.SQLiteCache(str(tmp_path / 'cache.sqlite'), max_bytes)
+        return cache.RedisCache(client=FakeRedis(), max_bytes=max_bytes)
+    return make
+
+def get_or_compute(backend, key, compute, ttl=60):
+    return cache.get_or_compute(backend, key, compute, ttl, dumps=lambda value: value, loads=lambda value: value)
+
+def test_concurrent_callers_compute_once(make_cache):
+    backend = make_cache()
+    calls = []
+
+    def compute():
+        calls.append(threading.get_ident())
+        time.sleep(0.3)
+        return b'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get_or_compute(backend, 'key', compute))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [b'value'] * 8
+
+def test_entries_expire_after_their_ttl(make_cache):
+    backend = make_cache()
+    backend.set('key', b'value', ttl=0.1)
+    assert backend.get('key') == b'value'
+    time.sleep(0.2)
+    assert backend.get('key') is None
+    assert get_or_compute(backend, 'key', lambda: b'new') == b'new'
+
+def test_least_recently_used_entries_are_evicted_past_max_bytes(make_cache):
+    backend = make_cache(max_bytes=250)
+    backend.set('a', b'a' * 100, ttl=60)
+    backend.set('b', b'b' * 100, ttl=60)
+    assert backend.get('a') is not None
+    backend.set('c', b'c' * 100, ttl=60)
+    assert backend.get('b') is None
+    assert backend.get('a') == b'a' * 100
+    assert backend.get('c') == b'c' * 100
+
+def test_expired_entries_do_not_count_towards_max_bytes(make_cache):
+    backend = make_cache(max_bytes=250)
+    backend.set('a', b'a' * 100, ttl=60)
+    # The most recently used entry, but expired by the time 'c' is stored
+    backend.set('b', b'b' * 100, ttl=0.1)
+    time.sleep(0.2)
+    backend.set('c', b'c' * 100, ttl=60)
+    assert backend.get('a') == b'a' * 100
+    assert backend.get('c') == b'c' * 100
@@ -0,0 +1,133 @@
+"""
+fetch_data against the local fake Socrata endpoint: paging, row order, retries and
+failures.
+"""
+import time
+from urllib.parse import parse_qs
+
+import pytest
+
+import escoles2
+from benchmarks import synthetic_data
+from benchmarks.fake_socrata import FakeSocrata
+
+PAGE_SIZE = 100
+QUERY = {'$select': ':id, codi_centre, curs, nivell'}
+
+@pytest.fixture(scope='module')
+def preinscripcio():
+    # About 900 rows, so 9 pages of PAGE_SIZE
+    return synthetic_data.make_datasets(n_schools=40, n_years=2, n_ensenyaments=3, max_levels=6)[synthetic_data.PREINSCRIPCIO_ID]
+
+def fetch(server, parallel=True, **kwargs):
+    return escoles2.fetch_data(server.url(synthetic_data.PREINSCRIPCIO_ID), QUERY, limit=PAGE_SIZE, parallel=parallel,
+                               backoff=0.01, **kwargs)
+
+class FailingPage(FakeSocrata):
+    # Answers the first ``times`` requests for the page at ``offset`` with ``response``
+    def __init__(self, datasets, offset, response=(503, ''), times=None, **kwargs):
+        super().__init__(datasets, **kwargs)
+        self.offset = offset
+        self.response = response
+        self.times = times
+
+    def respond(self, path, query):
+        if parse_qs(query).get('$offset') == [str(self.offset)] and self.times != 0:
+            if self.times:
+                self.times -= 1
+            return self.response
+        return super().respond(path, query)
+
+MALFORMED = (200, '":id","codi_centre","curs","nivell"\n"row-1","08000001"\n"row-2","08000002","2023/2024","1","extra"\n')
+
+@pytest.mark.parametrize('parallel', [True, False])
+def test_rows_come_back_in_order(preinscripcio, parallel):
+    with FakeSocrata({synthetic_data.PREINSCRIPCIO_ID: preinscripcio}) as server:
+        df = fetch(server, parallel)
+    assert len(preinscripcio) > 5 * PAGE_SIZE
+    assert df[':id'].tolist() == preinscripcio[':id'].tolist()
+    assert df['nivell'].tolist() == preinscripcio['nivell'].tolist()
+
+def test_parallel_download_is_faster(preinscripcio):
+    # With a round trip per page, the parallel pages overlap their waits
+    with FakeSocrata({synthetic_data.PREINSCRIPCIO_ID: preinscripcio}, latency=0.1) as server:
+        start = time.perf_counter()
+        fetch(server, parallel=False)
+        sequential = time.perf_counter() - start
+        start = time.perf_counter()
+        fetch(server, parallel=True)
+        parallel = time.perf_counter() - start
+    assert parallel < sequential / 2
+
+@pytest.mark.parametrize('parallel', [True, False])
+def test_503_responses_are_retried(preinscripcio, parallel):
+    with FakeSocrata({synthetic_data.PREINSCRIPCIO_ID: preinscripcio}, fail_every=3) as server:
+        df = fetch(server, parallel)
+        assert server.requests > len(preinscripcio) // PAGE_SIZE + 1
+    assert df[':id'].tolist() == preinscripcio[':id'].tolist()
+
+@pytest.mark.parametrize('parallel', [True, False])
+def test_a_page_that_keeps_failing_raises_fetch_error(preinscripcio, parallel):
+    with FailingPage({synthetic_data.PREINSCRIPCIO_ID: preinscripcio}, offset=3 * PAGE_SIZE) as server:
+        with pytest.raises(escoles2.FetchError):
+            fetch(server, parallel, retries=2)
+
+@pytest.mark.parametrize('parallel', [True, False])
+def test_a_malformed_page_is_retried(preinscripcio, parallel):
+    with FailingPage({synthetic_data.PREINSCRIPCIO_ID: preinscripcio}, offset=3 * PAGE_SIZE, response=MALFORMED, times=1) as server:
+        df = fetch(server, parallel)
+    assert df[':id'].tolist() == preinscripcio[':id'].tolist()
+
+@pytest.mark.parametrize('parallel', [True, False])
+def test_a_page_that_stays_malformed_raises_fetch_error(preinscripcio, parallel):
+    # Neither a hole in the parallel result nor an early end of the sequential one
+    with FailingPage({synthetic_data.PREINSCRIPCIO_ID: preinscripcio}, offset=3 * PAGE_SIZE, response=MALFORMED) as server:
+        with pytest.raises(escoles2.FetchError):
+            fetch(server, parallel, retries=2)
+
+@pytest.mark.parametrize('parallel', [True, False])
+def test_a_body_cut_short_is_retried(preinscripcio, parallel):
+    with FakeSocrata({synthetic_data.PREINSCRIPCIO_ID: preinscripcio}, truncate_every=4) as server:
+        df = fetch(server, parallel)
+    assert df[':id'].tolist() == preinscripcio[':id'].tolist()
+
+def test_a_header_only_page_ends_the_download(preinscripcio):
+    header = (200, '":id","codi_centre","curs","nivell"\n')
+    with FailingPage({synthetic_data.PREINSCRIPCIO_ID: preinscripcio}, offset=3 * PAGE_SIZE, response=header) as server:
+        df = fetch(server, parallel=False)
+    assert df[':id'].tolist() == preinscripcio[':id'].tolist()[:3 * PAGE_SIZE]
+
+def test_school_codes_keep_their_leading_zero(preinscripcio):
+    with FakeSocrata({synthetic_data.PREINSCRIPCIO_ID: preinscripcio}) as server:
+        df = fetch(server)
+    assert preinscripcio['codi_centre'].str.startswith('0').all()
+    assert df['codi_centre'].tolist() == preinscripcio['codi_centre'].tolist()
+
+def test_a_school_can_be_found_by_its_code(tmp_path, monkeypatch):
+    monkeypatch.setattr(escoles2, 'SNAPSHOT_DIR', str(tmp_path))
+    datasets = synthetic_data.make_datasets(n_schools=30, n_years=2)
+    with FakeSocrata(datasets) as server:
+        dataset = escoles2.load_prepared_dataset(server.url(synthetic_data.PREINSCRIPCIO_ID), server.url(synthetic_data.ESCOLES_ID))
+    assert dataset.search('08000007') == ['08000007']
+    # The directory rows were matched, so every school has its coordinates
+    assert dataset.df['coordenades_geo_x'].notna().all()
+
+def test_a_synced_snapshot_is_read_back(tmp_path, monkeypatch, preinscripcio):
+    monkeypatch.setattr(escoles2, 'SNAPSHOT_DIR', str(tmp_path))
+    with FakeSocrata({synthetic_data.PREINSCRIPCIO_ID: preinscripcio}) as server:
+        url = server.url(synthetic_data.PREINSCRIPCIO_ID)
+        # The system fields are added by the sync
+        query = {'$select': 'codi_centre, curs, nivell'}
+        escoles2.sync_dataset(url, query)
+    snapshot, updated_at = escoles2.read_snapshot(url, query)
+    assert updated_at is not None
+    assert snapshot['codi_centre'].tolist() == preinscripcio['codi_centre'].tolist()
+
+@pytest.mark.parametrize('parallel', [True, False])
+def test_a_column_read_as_numbers_in_some_pages_and_text_in_others_is_text(preinscripcio, parallel):
+    # The first pages only have digits, the later ones also words
+    observacions = [str(i) if i < 3 * PAGE_SIZE else f"nota {i}" for i in range(len(preinscripcio))]
+    with FakeSocrata({synthetic_data.PREINSCRIPCIO_ID: preinscripcio.assign(observacions=observacions)}) as server:
+        df = escoles2.fetch_data(server.url(synthetic_data.PREINSCRIPCIO_ID), {'$select': ':id, codi_centre, observacions'},
+                                 limit=PAGE_SIZE, parallel=parallel, backoff=0.01)
+    assert df['observacions'].tolist() == observacions
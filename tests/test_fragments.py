@@ -0,0 +1,54 @@
+"""
+Fragment-only reruns are traced like full reruns and redraw the debug panel in place.
+"""
+import functools
+from unittest import mock
+
+from streamlit.runtime.scriptrunner import RerunData
+from streamlit.testing.v1 import AppTest
+
+def app():
+    import streamlit as st
+
+    import escoles2
+    from telemetry import count, finish_trace, start_trace
+
+    trace = start_trace()
+    panel = st.sidebar.empty()
+    st.session_state['debug_panel'] = (panel, None, None)
+
+    @escoles2.traced_fragment
+    def fragment():
+        runs = st.session_state.setdefault('runs', 0)
+        st.session_state['runs'] = runs + 1
+        count('cache_calls.figure', 10 + runs)
+        st.write(f"run {runs}")
+
+    fragment()
+    escoles2.display_debug_panel(trace, None, None, panel)
+    finish_trace(trace)
+
+def rerun_fragments(app_test):
+    # AppTest only does full runs; queue every registered fragment as a browser would
+    fragment_ids = list(app_test._fragment_storage._fragments)
+    with mock.patch('streamlit.testing.v1.local_script_runner.RerunData',
+                    functools.partial(RerunData, fragment_id_queue=fragment_ids, is_fragment_scoped_rerun=True)):
+        app_test.run()
+
+def figure_calls(app_test):
+    # The hits of the panel's cache table, one panel per sidebar
+    return [table.value.set_index('cache')['hits'].to_dict() for table in app_test.sidebar.dataframe if 'cache' in table.value]
+
+def test_a_fragment_rerun_redraws_the_debug_panel():
+    app_test = AppTest.from_function(app)
+    app_test.query_params['debug'] = '1'
+    app_test.run()
+    assert figure_calls(app_test) == [{'figure': 10}]
+
+    for runs in (1, 2):
+        rerun_fragments(app_test)
+        assert not app_test.exception
+        assert [markdown.value for markdown in app_test.markdown if markdown.value.startswith('run')] == [f"run {runs}"]
+        # The fragment's own trace, shown once in place of the full run's panel
+        assert len(app_test.sidebar.subheader) == 1
+        assert figure_calls(app_test) == [{'figure': 10 + runs}]
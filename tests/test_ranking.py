@@ -0,0 +1,35 @@
+"""
+The demand cube behind the ranking tab and the two ends of a ranking.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import escoles2
+
+def school_rows(oversubscription_by_curs):
+    return pd.DataFrame([
+        {'codi_centre': '08000001', 'nom_ensenyament': 'Educació infantil de segon cicle', 'nivell': 1, 'curs': curs,
+         'denominaci_completa': 'Escola A', 'nom_municipi': 'Barcelona', 'nom_comarca': 'Barcelonès',
+         'oferta_inicial_places': 20, 'assignacions_1a_peticio': round(20 * value), 'assignacions_altres_peticions': 0}
+        for curs, value in oversubscription_by_curs.items()
+    ])
+
+def test_oversubscription_change_is_against_the_year_before():
+    cube = escoles2.build_demand_cube(school_rows({'2020/2021': 1.0, '2021/2022': 1.5, '2023/2024': 2.0, '2024/2025': 1.0}))
+    change = cube.set_index('curs')['oversubscription_change']
+    assert np.isnan(change['2020/2021'])
+    assert change['2021/2022'] == pytest.approx(0.5)
+    # 2022/2023 is missing, so there is no change to report for 2023/2024
+    assert np.isnan(change['2023/2024'])
+    assert change['2024/2025'] == pytest.approx(-1.0)
+
+@pytest.mark.parametrize('n', [3, 10, 11, 15, 19, 20, 35])
+def test_no_school_is_in_both_ends_of_the_ranking(n):
+    ranked = pd.DataFrame({'codi_centre': [f"{8000000 + i:08d}" for i in range(n)], 'oversubscription': np.linspace(2, 0, n)})
+    most, least = escoles2.ranking_ends(ranked)
+    assert most['codi_centre'].tolist() == ranked['codi_centre'].tolist()[:escoles2.RANKING_SIZE]
+    assert not set(most['codi_centre']) & set(least['codi_centre'])
+    assert len(least) == min(max(n - escoles2.RANKING_SIZE, 0), escoles2.RANKING_SIZE)
+    # Least demanded first
+    assert least['oversubscription'].is_monotonic_increasing
@@ -0,0 +1,47 @@
+"""
+DatasetRefresher against the fake Socrata endpoint: the dataset version follows the
+content of the snapshots, so a refresh that finds nothing new keeps the dataset.
+"""
+
+import pandas as pd
+import pytest
+
+import escoles2
+from benchmarks import synthetic_data
+from benchmarks.fake_socrata import FakeSocrata
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(escoles2, 'SNAPSHOT_DIR', str(tmp_path))
+    with FakeSocrata(synthetic_data.make_datasets(n_schools=30, n_years=2)) as server:
+        yield server
+
+def refresher(server):
+    return escoles2.DatasetRefresher(server.url(synthetic_data.PREINSCRIPCIO_ID), server.url(synthetic_data.ESCOLES_ID), interval=3600)
+
+def test_unchanged_data_keeps_its_version(server):
+    first = refresher(server)
+    version = first.dataset.version
+    first.stop()
+    assert first.last_refresh_summary['pages'] > 0
+
+    # Built from the snapshots at start, then refreshed without finding any change
+    second = refresher(server)
+    from_snapshots = second.dataset
+    second.refresh()
+    second.stop()
+    assert from_snapshots.version == version
+    assert second.dataset is from_snapshots
+
+def test_changed_data_gets_a_new_version(server):
+    current = refresher(server)
+    dataset = current.dataset
+
+    preinscripcio = server.datasets[synthetic_data.PREINSCRIPCIO_ID].copy()
+    preinscripcio.loc[0, 'assignacions_1a_peticio'] += 1
+    preinscripcio.loc[0, ':updated_at'] = preinscripcio[':updated_at'].max() + pd.Timedelta(seconds=1)
+    server.datasets[synthetic_data.PREINSCRIPCIO_ID] = preinscripcio
+    current.refresh()
+    current.stop()
+    assert current.dataset.version != dataset.version
+    assert current.last_refresh_summary['pages'] > 0
@@ -0,0 +1,17 @@
+"""
+Memory allocated by one rerun of the whole app must not grow with the dataset: the
+reruns only read the shared prepared dataset.
+"""
+
+from benchmarks import synthetic_data
+from benchmarks.fake_socrata import FakeSocrata
+from benchmarks.run_benchmarks import measure_reruns
+
+def rerun_peak(n_schools):
+    with FakeSocrata(synthetic_data.make_datasets(n_schools=n_schools, n_years=2)) as server:
+        return measure_reruns(server, repeat=3)['peak_bytes']
+
+def test_rerun_peak_stays_flat_as_the_data_grows():
+    small, large = rerun_peak(500), rerun_peak(4000)
+    # Eight times the schools, while the rerun's working set stays the same
+    assert large < small * 1.5, (small, large)
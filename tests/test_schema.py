@@ -0,0 +1,34 @@
+"""
+The compact dtypes of SCHOOL_SCHEMA: the merged frame shrinks, and a missing nivell
+(a nullable Int8) doesn't break the comparison selectors.
+"""
+
+from streamlit.testing.v1 import AppTest
+
+import escoles2
+from benchmarks import synthetic_data
+
+def test_the_schema_shrinks_the_school_frame():
+    datasets = synthetic_data.make_datasets(n_schools=100, n_years=3)
+    preinscripcio, escoles = datasets[synthetic_data.PREINSCRIPCIO_ID], datasets[synthetic_data.ESCOLES_ID]
+    report = escoles2.memory_report(escoles2.preprocess_school_data(preinscripcio, escoles, schema=None),
+                                    escoles2.preprocess_school_data(preinscripcio, escoles))
+    assert report.loc['total', 'ratio'] < 0.5
+    assert report.loc['nivell', 'dtype_after'] == 'Int8'
+    assert report.loc['codi_centre', 'dtype_after'] == 'category'
+
+def comparison_app():
+    import escoles2
+    from benchmarks import synthetic_data
+
+    datasets = synthetic_data.make_datasets(n_schools=5, n_years=2)
+    df = escoles2.preprocess_school_data(datasets[synthetic_data.PREINSCRIPCIO_ID], datasets[synthetic_data.ESCOLES_ID])
+    df.loc[df.index[:3], 'nivell'] = None
+    escoles2.display_comparison_chart(df)
+
+def test_rows_without_a_nivell_are_left_out_of_the_selector():
+    app_test = AppTest.from_function(comparison_app)
+    app_test.run()
+    assert not app_test.exception
+    nivells = app_test.selectbox(key='unique_nivell_key').options
+    assert nivells and '<NA>' not in nivells
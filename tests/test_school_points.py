@@ -0,0 +1,37 @@
+"""
+Static map points files: content-addressed names and pruning limited to the files
+the process wrote.
+"""
+import os
+
+import pandas as pd
+import pytest
+
+import escoles2
+
+@pytest.fixture(autouse=True)
+def fresh_process_state():
+    escoles2.published_school_points.clear()
+
+def points(n, offset=0):
+    return pd.DataFrame({
+        'coordenades_geo_x': [2.0 + i / 100 for i in range(offset, offset + n)],
+        'coordenades_geo_y': [41.0] * n,
+        'codi_centre': [f"{8000000 + i:08d}" for i in range(offset, offset + n)],
+        'denominaci_completa': [f"Escola {i}" for i in range(offset, offset + n)],
+    })
+
+def files(directory):
+    return sorted(os.listdir(directory))
+
+def test_the_same_points_share_one_file(tmp_path):
+    first = escoles2.publish_school_points(points(5), str(tmp_path))
+    assert escoles2.publish_school_points(points(5), str(tmp_path)) == first
+    assert escoles2.publish_school_points(points(6), str(tmp_path)) != first
+    assert len(files(tmp_path)) == 2
+
+def test_only_the_files_this_process_wrote_are_pruned(tmp_path):
+    # Written by another replica
+    (tmp_path / f"{escoles2.SCHOOL_POINTS_PREFIX}other.json").write_text('[]')
+    urls = [escoles2.publish_school_points(points(5, offset), str(tmp_path), keep=2) for offset in range(4)]
+    assert files(tmp_path) == sorted([f"{escoles2.SCHOOL_POINTS_PREFIX}other.json"] + [url.rsplit('/', 1)[-1] for url in urls[-2:]])
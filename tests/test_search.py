@@ -0,0 +1,55 @@
+"""
+The school search: normalized text and the ranking of SchoolSearchIndex matches.
+"""
+import pytest
+
+import escoles2
+
+@pytest.mark.parametrize('text, normalized', [
+    ('Escola Pia de Sarrià', 'escola pia de sarria'),
+    ('ÀÉÈÍÏÓÒÚÜÇ ñ', 'aeeiioouuc n'),
+    ('Col·legi', 'collegi'),
+    ('Coŀlegi', 'collegi'),
+    ('COĿLEGI', 'collegi'),
+    ("Institut Josep-Ramon d'Olot", 'institut josep ramon d olot'),
+    ('  08000035 ', '08000035'),
+    ('', ''),
+])
+def test_normalize_text(text, normalized):
+    assert escoles2.normalize_text(text) == normalized
+
+@pytest.fixture
+def index():
+    schools = {
+        '08000001': 'Escola Pia de Sarrià (Barcelona)',
+        '08000002': 'Col·legi Sant Ramon (Vic)',
+        '08000003': 'Institut Josep-Ramon Sarrià (Olot)',
+        '08000004': 'Escola Bressol Sant Jordi (Vic)',
+        '08000005': 'Escola Sol Ixent (Sant Cugat)',
+    }
+    return escoles2.SchoolSearchIndex(schools, [f"{code} {name}" for code, name in schools.items()])
+
+def test_accents_and_middle_dots_do_not_matter(index):
+    assert index.search('sarria') == index.search('SARRIÀ') == ['08000001', '08000003']
+    assert index.search('collegi') == index.search('coŀlegi') == index.search('col·legi') == ['08000002']
+
+def test_prefix_matches_come_before_substring_matches(index):
+    # 'sol' starts a word of 08000005 and is only inside 'bressol' of 08000004
+    assert index.search('sol') == ['08000005', '08000004']
+    assert index.search('ressol') == ['08000004']
+
+def test_every_word_must_match(index):
+    assert index.search('escola vic') == ['08000004']
+    assert index.search('sant vic') == ['08000002', '08000004']
+    assert index.search('escola olot') == []
+
+def test_a_school_is_found_by_its_code(index):
+    assert index.search('08000003') == ['08000003']
+
+def test_the_empty_query_returns_the_first_schools(index):
+    assert index.search('') == index.search(' · ') == ['08000001', '08000002', '08000003', '08000004', '08000005']
+    assert index.search('', k=2) == ['08000001', '08000002']
+
+def test_short_terms_only_match_prefixes(index):
+    # Two letters are too few to look inside words: 'ol' starts 'olot' but is also inside 'col·legi' and 'bressol'
+    assert index.search('ol') == ['08000003']
@@ -0,0 +1,94 @@
+"""
+sync_snapshot against the fake Socrata endpoint: only the changed rows are downloaded
+and merged by ``:id``, deletions upstream bring the whole dataset again, and a failed
+sync leaves the snapshot as it was.
+"""
+import functools
+import os
+
+import pandas as pd
+import pytest
+
+import escoles2
+from benchmarks import synthetic_data
+from benchmarks.fake_socrata import FakeSocrata
+
+QUERY = {'$select': 'codi_centre, curs, nivell, assignacions_1a_peticio'}
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(escoles2, 'SNAPSHOT_DIR', str(tmp_path))
+    datasets = synthetic_data.make_datasets(n_schools=20, n_years=2)
+    with FakeSocrata({synthetic_data.PREINSCRIPCIO_ID: datasets[synthetic_data.PREINSCRIPCIO_ID]}) as server:
+        yield server
+
+@pytest.fixture
+def downloads(monkeypatch):
+    # The queries fetch_data is asked for, to tell a delta from a full download
+    queries = []
+    fetch_data = escoles2.fetch_data
+
+    def recording_fetch_data(url, query=None, **kwargs):
+        queries.append(query)
+        return fetch_data(url, query, **kwargs)
+    monkeypatch.setattr(escoles2, 'fetch_data', recording_fetch_data)
+    return queries
+
+def url(server):
+    return server.url(synthetic_data.PREINSCRIPCIO_ID)
+
+def upstream(server):
+    return server.datasets[synthetic_data.PREINSCRIPCIO_ID]
+
+def by_id(df):
+    return df[[':id', *QUERY['$select'].split(', ')]].sort_values(':id').reset_index(drop=True)
+
+def test_changed_rows_are_merged_by_id(server, downloads):
+    escoles2.sync_snapshot(url(server), QUERY)
+
+    changed = upstream(server).copy()
+    later = changed[':updated_at'].max() + pd.Timedelta(seconds=1)
+    changed.loc[[0, 5], 'assignacions_1a_peticio'] += 7
+    changed.loc[[0, 5], ':updated_at'] = later
+    added = changed.iloc[[1]].assign(**{':id': 'row-new', ':updated_at': later})
+    server.datasets[synthetic_data.PREINSCRIPCIO_ID] = pd.concat([changed, added], ignore_index=True)
+    del downloads[:]
+
+    synced = escoles2.sync_snapshot(url(server), QUERY)
+    # Only the rows updated since the snapshot were asked for
+    assert [":updated_at >" in query.get('$where', '') for query in downloads] == [True]
+    expected = by_id(upstream(server))
+    assert by_id(synced).equals(expected)
+    assert by_id(escoles2.read_snapshot(url(server), QUERY)[0]).equals(expected)
+
+def test_deleted_rows_bring_the_whole_dataset_again(server, downloads):
+    escoles2.sync_snapshot(url(server), QUERY)
+
+    # Deleted rows leave no :updated_at behind, only a smaller row count
+    server.datasets[synthetic_data.PREINSCRIPCIO_ID] = upstream(server).drop(index=[2, 3]).reset_index(drop=True)
+    del downloads[:]
+
+    synced = escoles2.sync_snapshot(url(server), QUERY)
+    assert ["$where" in query for query in downloads] == [True, False]
+    expected = by_id(upstream(server))
+    assert by_id(synced).equals(expected)
+    assert by_id(escoles2.read_snapshot(url(server), QUERY)[0]).equals(expected)
+
+def test_a_failed_sync_leaves_the_snapshot_as_it_was(server, monkeypatch):
+    escoles2.sync_snapshot(url(server), QUERY)
+    path = escoles2.snapshot_path(url(server), QUERY)
+    with open(path, 'rb') as f:
+        written = f.read()
+
+    changed = upstream(server).copy()
+    changed[':updated_at'] = changed[':updated_at'].max() + pd.Timedelta(seconds=1)
+    server.datasets[synthetic_data.PREINSCRIPCIO_ID] = changed
+    # Socrata answers 503 to every request, retried without waiting
+    server.fail_every = 1
+    monkeypatch.setattr(escoles2, 'fetch_data', functools.partial(escoles2.fetch_data, backoff=0))
+    with pytest.raises(escoles2.FetchError):
+        escoles2.sync_snapshot(url(server), QUERY)
+
+    with open(path, 'rb') as f:
+        assert f.read() == written
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name != os.path.basename(path)]
@@ -0,0 +1,42 @@
+"""
+SchoolSpatialIndex.nearest against a brute-force scan, including queries asking for
+more points than the index holds.
+"""
+from unittest import mock
+
+import numpy as np
+import pytest
+
+import escoles2
+
+@pytest.fixture(scope='module')
+def points():
+    rng = np.random.default_rng(0)
+    return rng.uniform(40.5, 42.8, 2000), rng.uniform(0.2, 3.3, 2000)
+
+@pytest.mark.parametrize('lat, lon, k', [(41.39, 2.17, 1), (41.39, 2.17, 25), (10.0, 10.0, 3), (41.39, 2.17, 5000)])
+def test_nearest_matches_brute_force(points, lat, lon, k):
+    lats, lons = points
+    positions, distances = escoles2.SchoolSpatialIndex(lats, lons).nearest(lat, lon, k)
+    expected = np.sort(escoles2.haversine(lat, lon, lats, lons))[:k]
+    assert np.allclose(distances, expected)
+    assert np.allclose(escoles2.haversine(lat, lon, lats[positions], lons[positions]), distances)
+
+def test_nearest_stops_growing_past_the_grid():
+    # Asking for more points than there are must not widen the search to the whole globe
+    index = escoles2.SchoolSpatialIndex([41.38, 41.39, 41.40, 41.50, 41.60], [2.17, 2.18, 2.19, 2.20, 2.30])
+    with mock.patch.object(index, 'within_radius', wraps=index.within_radius) as within_radius:
+        positions, _ = index.nearest(41.38, 2.17, 10)
+    assert positions.tolist() == [0, 1, 2, 3, 4]
+
+    def covers_the_grid(radius):
+        low, high = index._box(41.38, 2.17, radius)
+        return np.all(low <= index.cell_bounds[0]) and np.all(high >= index.cell_bounds[1])
+    # The radius doubled until its box covered the grid, and not once more
+    radii = [call.args[2] for call in within_radius.call_args_list]
+    assert radii == [radii[0] * 2 ** i for i in range(len(radii))]
+    assert covers_the_grid(radii[-1]) and not covers_the_grid(radii[-2])
+
+def test_nearest_on_an_empty_index():
+    positions, distances = escoles2.SchoolSpatialIndex([], []).nearest(41.38, 2.17, 3)
+    assert len(positions) == len(distances) == 0
@@ -0,0 +1,60 @@
+"""
+Only the open tab is drawn, and Streamlit drops the state of the widgets it doesn't
+draw: the choices made in a tab must survive opening another one.
+"""
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import escoles2
+from benchmarks import synthetic_data
+from benchmarks.fake_socrata import FakeSocrata
+
+SEARCH_TAB, COMPARE_TAB = "Busca una escola", "Compara escoles"
+
+@pytest.fixture
+def app_test(tmp_path, monkeypatch):
+    with FakeSocrata(synthetic_data.make_datasets(n_schools=30, n_years=2)) as server:
+        monkeypatch.setenv('ESCOLES_PREINSCRIPCIO_URL', server.url(synthetic_data.PREINSCRIPCIO_ID))
+        monkeypatch.setenv('ESCOLES_ESCOLES_URL', server.url(synthetic_data.ESCOLES_ID))
+        monkeypatch.setenv('ESCOLES_SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+        monkeypatch.setenv('ESCOLES_ARTIFACT_DIR', str(tmp_path / 'artifacts'))
+        monkeypatch.setenv('ESCOLES_STATIC_DIR', str(tmp_path / 'static'))
+        app_test = AppTest.from_file(escoles2.__file__, default_timeout=60)
+        app_test.run()
+        assert not app_test.exception
+        yield app_test
+
+def open_tab(app_test, tab):
+    # AppTest doesn't keep the open tab between runs
+    app_test.session_state['active_tab'] = tab
+    app_test.run()
+    assert not app_test.exception
+
+def test_the_selected_school_survives_a_tab_switch(app_test):
+    open_tab(app_test, SEARCH_TAB)
+    app_test.text_input(key='school_query').input('escola')
+    open_tab(app_test, SEARCH_TAB)
+    first = app_test.selectbox(key='school_code').value
+    app_test.selectbox(key='school_code').select_index(1)
+    open_tab(app_test, SEARCH_TAB)
+    code = app_test.selectbox(key='school_code').value
+    assert code != first
+
+    open_tab(app_test, COMPARE_TAB)
+    open_tab(app_test, SEARCH_TAB)
+    assert app_test.text_input(key='school_query').value == 'escola'
+    assert app_test.selectbox(key='school_code').value == code
+
+def test_the_compared_schools_survive_a_tab_switch(app_test):
+    open_tab(app_test, COMPARE_TAB)
+    # AppTest lists the options by their label
+    multiselect = app_test.multiselect(key='compare_codes')
+    multiselect.set_value(multiselect.options[:3])
+    open_tab(app_test, COMPARE_TAB)
+    codes = app_test.multiselect(key='compare_codes').value
+    assert len(codes) == 3
+
+    open_tab(app_test, SEARCH_TAB)
+    open_tab(app_test, COMPARE_TAB)
+    assert app_test.multiselect(key='compare_codes').value == codes